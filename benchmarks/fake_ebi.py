@@ -0,0 +1,249 @@
+""" Local stand-in for the EBI endpoints the crawlers talk to:
+the ENA portal search, the ENA browser XML API (projects and their pubmed links) and the MGnify studies API.
+All data is synthetic and derived from (seed, study index), so every run sees the same records. """
+import json
+import random
+import re
+import threading
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+TAX_TREES = (9606, 256318, 33208, 33090)
+TAX_TREE_WEIGHTS = (0.5, 0.3, 0.15, 0.05)
+LINEAGES = {"root:Host-associated:Human": 9606, "root:Host-associated:Mammals": 33208}
+FIRST_DATE = date(2015, 1, 1)
+N_DAYS = 10 * 365
+
+HOSTS = ("Homo sapiens", "Mus musculus", "Sus scrofa", "")
+BODY_SITES = ("gut", "skin", "oral cavity", "vagina", "")
+INSTRUMENTS = ("Illumina HiSeq 2500", "Illumina HiSeq 4000", "Illumina NovaSeq 6000", "Illumina MiSeq")
+
+
+class SyntheticStudy:
+    def __init__(self, index, seed, samples_per_study, runs_per_sample):
+        rng = random.Random(seed * 1000003 + index)
+        self.index = index
+        self.accession = f"PRJEB{10000 + index}"
+        self.title = f"Synthetic metagenome study {index}"
+        self.first_public = (FIRST_DATE + timedelta(days=rng.randrange(N_DAYS))).isoformat()
+        self.last_updated = max(self.first_public, (FIRST_DATE + timedelta(days=rng.randrange(N_DAYS))).isoformat())
+        self.tax_trees = {rng.choices(TAX_TREES, TAX_TREE_WEIGHTS)[0]}
+        if 9606 in self.tax_trees and rng.random() < 0.3:
+            # human gut metagenomes are in both trees
+            self.tax_trees.add(256318)
+        self.pubmed_ids = [str(20000000 + index * 3 + i) for i in range(rng.choice((0, 0, 1, 2)))]
+        self.host = rng.choice(HOSTS)
+        self.body_site = rng.choice(BODY_SITES)
+        self.instrument = rng.choice(INSTRUMENTS)
+        self.layout = rng.choice(("PAIRED", "SINGLE"))
+        self.strategy, self.source = rng.choice((("WGS", "METAGENOMIC"), ("RNA-Seq", "METATRANSCRIPTOMIC")))
+        if rng.random() < 0.02:
+            # a few records come without a first_public date
+            self.first_public = ""
+        self.samples_per_study = samples_per_study
+        self.runs_per_sample = runs_per_sample
+    @property
+    def n_runs(self):
+        return self.samples_per_study * self.runs_per_sample
+    def get_run(self, i):
+        """ i-th read_run record of the study, with all portal fields """
+        sample = self.index * self.samples_per_study + i // self.runs_per_sample
+        run = self.index * self.n_runs + i
+        return {
+            "study_accession": self.accession, "study_title": self.title,
+            "sample_accession": f"SAMEA{1000000 + sample}", "run_accession": f"ERR{1000000 + run}",
+            "experiment_title": f"{self.instrument} {self.layout.lower()} end sequencing",
+            "description": f"{self.instrument} sequencing of sample {sample}",
+            "host": self.host, "host_body_site": self.body_site,
+            "host_tax_id": "9606" if self.host == "Homo sapiens" else "",
+            "instrument_model": self.instrument, "instrument_platform": "ILLUMINA",
+            "library_source": self.source, "library_layout": self.layout, "library_strategy": self.strategy,
+            "nominal_length": "300" if self.layout == "PAIRED" else "", "read_count": str(1000000 + run % 997 * 1000),
+            "environment_biome": "", "first_public": self.first_public, "last_updated": self.last_updated,
+        }
+    def to_xml(self):
+        links = "".join(f"<PROJECT_LINK><XREF_LINK><DB>PUBMED</DB><ID>{pubmed_id}</ID></XREF_LINK></PROJECT_LINK>"
+                        for pubmed_id in self.pubmed_ids)
+        return (f'<PROJECT accession="{self.accession}"><IDENTIFIERS><PRIMARY_ID>{self.accession}</PRIMARY_ID></IDENTIFIERS>'
+                f"<TITLE>{escape(self.title)}</TITLE><PROJECT_LINKS>{links}</PROJECT_LINKS>"
+                f"<PROJECT_ATTRIBUTES><PROJECT_ATTRIBUTE><TAG>ENA-FIRST-PUBLIC</TAG><VALUE>{self.first_public}</VALUE></PROJECT_ATTRIBUTE>"
+                f"<PROJECT_ATTRIBUTE><TAG>ENA-LAST-UPDATE</TAG><VALUE>{self.last_updated}</VALUE></PROJECT_ATTRIBUTE>"
+                f"</PROJECT_ATTRIBUTES></PROJECT>")
+    def to_mgnify(self):
+        return {"id": f"MGYS{self.index:08d}", "attributes": {
+            "bioproject": self.accession, "accession": f"ERP{10000 + self.index}", "samples-count": self.samples_per_study,
+            "secondary-accession": f"ERP{10000 + self.index}", "centre-name": "SYNTHETIC", "is-public": True,
+            "public-release-date": None, "study-abstract": self.title, "study-name": self.title,
+            "data-origination": "SUBMITTED", "last-update": f"{self.last_updated}T00:00:00",
+        }}
+
+
+class SyntheticDataset:
+    def __init__(self, n_studies=1000, samples_per_study=5, runs_per_sample=2, seed=1):
+        self.studies = [SyntheticStudy(i, seed, samples_per_study, runs_per_sample) for i in range(n_studies)]
+        self.by_accession = {study.accession: study for study in self.studies}
+        self._selections = dict()
+        self.lock = threading.Lock()
+    @property
+    def n_runs(self):
+        return sum(study.n_runs for study in self.studies)
+    def select(self, tax_tree=None, bounds=(), or_empty=()):
+        """ studies in portal order (by accession) that match the tax tree
+        and the (field, ">=" or "<", date) bounds on first_public / last_updated.
+        An empty date matches no bound, unless its field is in or_empty (field="") """
+        key = tax_tree, bounds, or_empty
+        with self.lock:
+            if key not in self._selections:
+                self._selections[key] = [study for study in self.studies
+                                         if (tax_tree is None or tax_tree in study.tax_trees)
+                                         and all((getattr(study, field) >= value) == (op == ">=") if getattr(study, field)
+                                                 else field in or_empty for field, op, value in bounds)]
+            return self._selections[key]
+    def get_runs(self, studies, offset, limit):
+        """ offset pagination over the runs of studies, without materialising the skipped ones """
+        runs = list()
+        for study in studies:
+            if offset >= study.n_runs:
+                offset -= study.n_runs
+                continue
+            for i in range(offset, study.n_runs):
+                if len(runs) == limit:
+                    return runs
+                runs.append(study.get_run(i))
+            offset = 0
+        return runs
+
+
+class FakeEBIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type):
+        body = body.encode()
+        self.server.count(self.endpoint, len(body))
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path == "/ena/portal/api/search":
+            self.endpoint = "portal_search"
+            self._portal_search(params)
+        elif url.path.startswith("/ena/browser/api/xml/"):
+            self.endpoint = "browser_xml"
+            self._browser_xml(unquote(url.path.rsplit("/", 1)[-1]).split(","))
+        elif url.path == "/metagenomics/api/latest/studies":
+            self.endpoint = "mgnify_studies"
+            self._mgnify_studies(params)
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        length = int(self.headers.get("Content-Length", 0))
+        params = parse_qs(self.rfile.read(length).decode())
+        if url.path == "/ena/browser/api/xml":
+            self.endpoint = "browser_xml"
+            self._browser_xml(params.get("accessions", list()))
+        else:
+            self.send_error(404)
+
+    def _portal_search(self, params):
+        query = params.get("query", "")
+        tax_tree = re.search(r"tax_tree\((\d+)\)", query)
+        bounds = tuple(re.findall(r"(first_public|last_updated)(>=|<)(\d{4}-\d{2}-\d{2})", query))
+        or_empty = tuple(re.findall(r'(first_public|last_updated)=""', query))
+        studies = self.server.dataset.select(int(tax_tree.group(1)) if tax_tree else None, bounds=bounds, or_empty=or_empty)
+        runs = self.server.dataset.get_runs(studies, int(params.get("offset", 0)), int(params.get("limit", 100000)))
+        fields = ["run_accession", "sample_accession"] + [field for field in params.get("fields", "").split(",")
+                                                            if field and field not in ("run_accession", "sample_accession")]
+        if not runs:
+            # the portal sends an empty body once the results are exhausted
+            self._send("", "text/plain")
+        elif params.get("format") == "tsv":
+            lines = ["\t".join(fields)] + ["\t".join(run.get(field, "") for field in fields) for run in runs]
+            self._send("\n".join(lines) + "\n", "text/plain")
+        else:
+            self._send(json.dumps([{field: run.get(field, "") for field in fields} for run in runs]), "application/json")
+
+    def _browser_xml(self, accessions):
+        projects = list()
+        for accession in accessions:
+            study = self.server.dataset.by_accession.get(accession.strip())
+            if study is not None:
+                projects.append(study.to_xml())
+        self._send(f"<?xml version='1.0' encoding='UTF-8'?><PROJECT_SET>{''.join(projects)}</PROJECT_SET>", "application/xml")
+
+    def _mgnify_studies(self, params):
+        tax_tree = LINEAGES.get(params.get("lineage"))
+        studies = self.server.dataset.select(tax_tree) if tax_tree else list()
+        ordering = params.get("ordering", "")
+        if ordering.lstrip("-") == "last_update":
+            studies = sorted(studies, key=lambda study: study.last_updated, reverse=ordering.startswith("-"))
+        page_size = int(params.get("page_size", 25))
+        page = int(params.get("page", 1))
+        n_pages = max(1, -(-len(studies) // page_size))
+        if page > n_pages:
+            self.send_error(404)
+            return
+        data = [study.to_mgnify() for study in studies[(page - 1) * page_size:page * page_size]]
+        self._send(json.dumps({"data": data, "meta": {"pagination": {"page": page, "pages": n_pages, "count": len(studies)}}}),
+                   "application/json")
+
+
+class FakeEBIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, dataset, host="127.0.0.1", port=0):
+        super().__init__((host, port), FakeEBIHandler)
+        self.dataset = dataset
+        self.counts_lock = threading.Lock()
+        self.requests = dict()
+        self.bytes_sent = dict()
+    def count(self, endpoint, n_bytes):
+        with self.counts_lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.bytes_sent[endpoint] = self.bytes_sent.get(endpoint, 0) + n_bytes
+    def get_counts(self):
+        with self.counts_lock:
+            return dict(self.requests), dict(self.bytes_sent)
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+    @property
+    def portal_url(self):
+        return self.base_url + "/ena/portal/api/"
+    @property
+    def browser_xml_url(self):
+        return self.base_url + "/ena/browser/api/xml"
+    @property
+    def mgnify_url(self):
+        return self.base_url + "/metagenomics/api/latest"
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+
+if __name__ == "__main__":
+    import argparse
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=8000)
+    ap.add_argument("--studies", type=int, default=1000)
+    ap.add_argument("--samples-per-study", type=int, default=5)
+    ap.add_argument("--runs-per-sample", type=int, default=2)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    dataset = SyntheticDataset(args.studies, args.samples_per_study, args.runs_per_sample, seed=args.seed)
+    server = FakeEBIServer(dataset, port=args.port)
+    print(f"serving {len(dataset.studies)} studies / {dataset.n_runs} runs at {server.base_url}")
+    server.serve_forever()
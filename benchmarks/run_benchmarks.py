@@ -0,0 +1,323 @@
+""" Crawler benchmarks against the local EBI stand-in (fake_ebi.py).
+
+Every benchmark runs in its own process, so that its peak RSS is its own:
+    python benchmarks/run_benchmarks.py --studies 2000 --output bench.json
+    python benchmarks/run_benchmarks.py --studies 2000 --compare bench.json
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import re
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PACKAGE = os.path.join(os.path.dirname(HERE), "mgscryer")
+SQLITE = os.path.join(os.path.dirname(HERE), "sqlite")
+sys.path.insert(0, PACKAGE)
+sys.path.insert(1, os.path.join(PACKAGE, "app"))
+
+from fake_ebi import FakeEBIServer, SyntheticDataset
+
+# in this order: display, portal_incremental and portal_parallel work on the db or log of portal_full
+BENCHMARKS = ["portal_full", "portal_incremental", "portal_parallel", "portal_stream", "filldb", "filldb_bulk", "filldb_sharded", "pubmed", "display", "mgnify"]
+
+
+def create_db(path, schema):
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    with open(os.path.join(SQLITE, schema)) as _in:
+        conn.executescript(_in.read())
+    conn.close()
+
+def set_last_update(path, timestamp):
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute("UPDATE timepoints SET date_time = ? WHERE action = 'last_update';", (timestamp,))
+    conn.close()
+
+def count_records(table):
+    from metrics import METRICS
+    return sum(value for (name, labels), value in METRICS.counters.items()
+               if name == "records_total" and ("table", table) in labels)
+
+def count_written_runs(args, db, tax_trees):
+    """ the runs in db, fails the benchmark if records were rejected or runs of the dataset are missing """
+    conn = sqlite3.connect(db)
+    n_runs = conn.execute("SELECT COUNT(*) FROM run;").fetchone()[0]
+    n_rejected = conn.execute("SELECT COUNT(*) FROM load_reject;").fetchone()[0]
+    conn.close()
+    if n_rejected:
+        raise RuntimeError(f"{n_rejected} records were rejected, see load_reject in {db}")
+    # a study in several tax trees is read once per tree, but written once
+    dataset = SyntheticDataset(args.studies, args.samples_per_study, args.runs_per_sample, seed=args.seed)
+    studies = {study.accession: study for tax_tree in tax_trees for study in dataset.select(tax_tree)}
+    expected = sum(study.n_runs for study in studies.values())
+    if n_runs != expected:
+        raise RuntimeError(f"{n_runs} runs written, the portal has {expected}")
+    return n_runs
+
+def check_changes(db):
+    """ fails the benchmark unless the change log of a backfill into an empty db,
+    as its consumers read it, has one insert per study, sample and run in the db and nothing else """
+    from changes import ENTITIES, iter_changes
+    conn = sqlite3.connect(db)
+    cursor = conn.cursor()
+    logged = dict()
+    for change in iter_changes(cursor):
+        logged.setdefault(change["entity"], list()).append((change["accession"], change["kind"]))
+    for entity in ENTITIES:
+        cursor.execute(f"SELECT {entity}_accession, 'insert' FROM {entity};")
+        expected = sorted(cursor.fetchall())
+        if sorted(logged.get(entity, list())) != expected:
+            raise RuntimeError(f"the change log has {len(logged.get(entity, list()))} {entity} changes, "
+                               f"expected an insert for each of the {len(expected)} {entity} rows")
+    conn.close()
+
+def count_statements():
+    """ counts the sql statements run on the connections opened from here on, in this process only.
+    executemany counts once per row, and the tracing roughly doubles the time of bulk writes. """
+    counter = {"statements": 0}
+    connect = sqlite3.connect
+    def count(statement):
+        counter["statements"] += 1
+    def counting_connect(*args, **kwargs):
+        conn = connect(*args, **kwargs)
+        conn.set_trace_callback(count)
+        return conn
+    sqlite3.connect = counting_connect
+    return counter
+
+
+def run_portal(args, db, stream=False, parallel_trees=False):
+    import ena_portal_scryer
+    from pubmed import PubmedQuery
+    PubmedQuery.URL = args.browser_xml_url
+    scryer = ena_portal_scryer.EnaPortalScryer(db, base_url=args.portal_url, limit=args.limit, sleep_interval=0,
+                                               batch_size=args.batch_size, concurrency=args.concurrency, stream=stream,
+                                               parallel_trees=parallel_trees)
+    scryer.run()
+    return count_records("run")
+
+def bench_portal_full(args):
+    db = os.path.join(args.workdir, "portal.sqlite")
+    create_db(db, "create_ena_portal_db.sql")
+    set_last_update(db, "1970-01-01T00:00:00")
+    return run_portal(args, db)
+
+def bench_portal_incremental(args):
+    # everything older than the cutoff is already in the db from portal_full
+    db = os.path.join(args.workdir, "portal_incremental.sqlite")
+    shutil.copy(os.path.join(args.workdir, "portal.sqlite"), db)
+    set_last_update(db, args.incremental_since + "T00:00:00")
+    return run_portal(args, db)
+
+def bench_portal_parallel(args):
+    # the same crawl as portal_full, only with the tax trees in parallel: it has to report the same
+    db = os.path.join(args.workdir, "portal_parallel.sqlite")
+    create_db(db, "create_ena_portal_db.sql")
+    set_last_update(db, "1970-01-01T00:00:00")
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        n_records = run_portal(args, db, parallel_trees=True)
+    print(log.getvalue(), end="")
+    with open(os.path.join(args.workdir, "portal_full.log")) as _in:
+        expected = get_tax_tree_summaries(_in.read())
+    if get_tax_tree_summaries(log.getvalue()) != expected:
+        raise RuntimeError("the parallel crawl reported other tax tree summaries than portal_full:\n" + "\n".join(expected))
+    return n_records
+
+def get_tax_tree_summaries(log):
+    """ the "<label> (<tax tree>): studies n|n, ..." lines of a portal crawl, in order """
+    return re.findall(r"^.+ \(\d+\): .+$", log, flags=re.MULTILINE)
+
+def bench_portal_stream(args):
+    db = os.path.join(args.workdir, "portal_stream.sqlite")
+    create_db(db, "create_ena_portal_db.sql")
+    set_last_update(db, "1970-01-01T00:00:00")
+    return run_portal(args, db, stream=True)
+
+def bench_filldb(args, bulk=False):
+    import ena_portal_scryer_filldb
+    from pubmed import PubmedQuery
+    PubmedQuery.URL = args.browser_xml_url
+    ena_portal_scryer_filldb.BASE_API_URL = args.portal_url
+    db = os.path.join(args.workdir, "filldb_bulk.sqlite" if bulk else "filldb.sqlite")
+    create_db(db, "create_ena_portal_db.sql")
+    ena_portal_scryer_filldb.backfill(argparse.Namespace(db=db, stream=False, resume=False, bulk=bulk, chunk_size=50000,
+                                                          pubmed_max_age=30))
+    check_changes(db)
+    return count_written_runs(args, db, ena_portal_scryer_filldb.TAX_TREES)
+
+def bench_filldb_bulk(args):
+    return bench_filldb(args, bulk=True)
+
+def bench_filldb_sharded(args):
+    import ena_portal_scryer_sharded
+    from pubmed import PubmedQuery
+    PubmedQuery.URL = args.browser_xml_url
+    ena_portal_scryer_sharded.BASE_API_URL = args.portal_url
+    db = os.path.join(args.workdir, "filldb_sharded.sqlite")
+    create_db(db, "create_ena_portal_db.sql")
+    # the synthetic studies are first public from 2015 on
+    ena_portal_scryer_sharded.sharded_backfill(argparse.Namespace(
+        db=db, processes=args.concurrency, window_field="first_public", window_months=12, first_window="2015-01-01",
+        shard_dir=None, stream=False, requests_per_second=None, chunk_size=50000, resume=False,
+        pubmed_max_age=30))
+    return count_written_runs(args, db, ena_portal_scryer_sharded.TAX_TREES)
+
+def bench_pubmed(args):
+    from pubmed import PubmedQuery
+    PubmedQuery.URL = args.browser_xml_url
+    studies = SyntheticDataset(args.studies, args.samples_per_study, args.runs_per_sample, seed=args.seed).by_accession
+    n_studies = 0
+    for accessions, _ in PubmedQuery.get_links(studies, concurrency=args.concurrency, requests_per_second=None):
+        n_studies += len(accessions)
+    return n_studies
+
+def bench_display(args):
+    from display import iter_display_data
+    conn = sqlite3.connect(os.path.join(args.workdir, "portal.sqlite"))
+    n_studies = 0
+    for chunk in iter_display_data(conn.cursor()):
+        n_studies += 1
+    return n_studies
+
+def bench_mgnify(args):
+    spec = importlib.util.spec_from_file_location("mgnify_scryer", os.path.join(PACKAGE, "__main__.py"))
+    mgnify = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mgnify)
+    mgnify.APIBASE = args.mgnify_url
+    db = os.path.join(args.workdir, "mgnify.sqlite")
+    create_db(db, "create_db.sql")
+    mgnify.get_mgnify_studies(db, concurrency=args.concurrency)
+    return count_records("study")
+
+
+def run_worker(args):
+    """ runs one benchmark in this process and writes its result next to its log """
+    bench = globals()[f"bench_{args.worker}"]
+    log_path = os.path.join(args.workdir, f"{args.worker}.log")
+    statements = count_statements() if args.db_statements else None
+    with open(log_path, "w") as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        start = time.perf_counter()
+        n_records = bench(args)
+        seconds = time.perf_counter() - start
+    result = {
+        "records": n_records,
+        "seconds": seconds,
+        "db_statements": statements["statements"] if statements else None,
+        "records_per_second": n_records / seconds if seconds else 0.0,
+        # kilobytes on linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    with open(os.path.join(args.workdir, f"{args.worker}.json"), "w") as _out:
+        json.dump(result, _out)
+
+def run_benchmark(name, args, server):
+    requests_before, bytes_before = server.get_counts()
+    cmd = [sys.executable, os.path.abspath(__file__), "--worker", name, "--workdir", args.workdir,
+           "--base-url", server.base_url]
+    cmd += [f"--{key.replace('_', '-')}={value}" for key, value in sorted(vars(args).items())
+            if key in ("studies", "samples_per_study", "runs_per_sample", "seed", "limit", "batch_size",
+                       "concurrency", "incremental_since")]
+    if args.db_statements:
+        cmd.append("--db-statements")
+    completed = subprocess.run(cmd)
+    if completed.returncode != 0:
+        print(f"{name} failed, see {os.path.join(args.workdir, name + '.log')}", file=sys.stderr)
+        return None
+    with open(os.path.join(args.workdir, f"{name}.json")) as _in:
+        result = json.load(_in)
+    requests_after, bytes_after = server.get_counts()
+    result["requests"] = {endpoint: n - requests_before.get(endpoint, 0) for endpoint, n in requests_after.items()
+                          if n > requests_before.get(endpoint, 0)}
+    result["bytes_served"] = sum(bytes_after.values()) - sum(bytes_before.values())
+    return result
+
+def print_results(results, previous=None):
+    print(f"{'benchmark':<20}{'records':>10}{'seconds':>10}{'rec/s':>12}{'peak MB':>10}{'db stmts':>10}  http requests")
+    for name, result in results.items():
+        if result is None:
+            print(f"{name:<20}failed")
+            continue
+        db_statements = "-" if result.get("db_statements") is None else result["db_statements"]
+        line = (f"{name:<20}{result['records']:>10}{result['seconds']:>10.2f}{result['records_per_second']:>12.1f}"
+                f"{result['peak_rss_mb']:>10.1f}{db_statements:>10}  {sum(result['requests'].values())}")
+        old = (previous or dict()).get(name)
+        if old and old.get("records_per_second"):
+            line += f"  ({result['records_per_second'] / old['records_per_second'] - 1:+.1%} rec/s," \
+                    f" {result['peak_rss_mb'] - old['peak_rss_mb']:+.1f} MB)"
+        print(line)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--studies", type=int, default=1000)
+    ap.add_argument("--samples-per-study", type=int, default=5)
+    ap.add_argument("--runs-per-sample", type=int, default=2)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--limit", type=int, default=1000, help="portal page size")
+    ap.add_argument("--batch-size", type=int, default=1000)
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--incremental-since", default="2023-01-01", help="last_update for portal_incremental")
+    ap.add_argument("--db-statements", action="store_true",
+                    help="count the sql statements of each benchmark, at the cost of slower db writes")
+    ap.add_argument("--only", help="comma-separated benchmarks, from: " + ",".join(BENCHMARKS))
+    ap.add_argument("--workdir", help="keep dbs and logs here instead of a temporary directory")
+    ap.add_argument("--output", help="write the results as json")
+    ap.add_argument("--compare", help="results json of an earlier run")
+    ap.add_argument("--worker", help=argparse.SUPPRESS)
+    ap.add_argument("--base-url", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker:
+        args.portal_url = args.base_url + "/ena/portal/api/"
+        args.browser_xml_url = args.base_url + "/ena/browser/api/xml"
+        args.mgnify_url = args.base_url + "/metagenomics/api/latest"
+        run_worker(args)
+        return
+
+    benchmarks = args.only.split(",") if args.only else BENCHMARKS
+    if {"portal_incremental", "portal_parallel", "display"}.intersection(benchmarks) and "portal_full" not in benchmarks:
+        benchmarks.insert(0, "portal_full")
+    benchmarks = [name for name in BENCHMARKS if name in benchmarks]
+
+    dataset = SyntheticDataset(args.studies, args.samples_per_study, args.runs_per_sample, seed=args.seed)
+    server = FakeEBIServer(dataset).start()
+    print(f"{len(dataset.studies)} studies, {dataset.n_runs} runs at {server.base_url}", file=sys.stderr)
+
+    tmpdir = None
+    if not args.workdir:
+        tmpdir = args.workdir = tempfile.mkdtemp(prefix="mgscryer_bench_")
+    else:
+        os.makedirs(args.workdir, exist_ok=True)
+    try:
+        results = {name: run_benchmark(name, args, server) for name in benchmarks}
+    finally:
+        server.shutdown()
+        if tmpdir:
+            shutil.rmtree(tmpdir)
+
+    previous = None
+    if args.compare:
+        with open(args.compare) as _in:
+            previous = json.load(_in)["results"]
+    print_results(results, previous=previous)
+    if args.output:
+        scale = {key: getattr(args, key) for key in ("studies", "samples_per_study", "runs_per_sample", "seed")}
+        with open(args.output, "w") as _out:
+            json.dump({"scale": scale, "results": results}, _out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,9 +5,12 @@ SCRYER_PATH=/congo/DB/MGSCRYER
 SCRYER_DB=$SCRYER_PATH/mgscryer_db.sqlite
 SCRYER=/home/schudoma/mgscryer/mgscryer/ena_portal_scryer.py
 SCRYER_LOGS=$SCRYER_PATH/logs
+# picked up by the node_exporter textfile collector
+SCRYER_METRICS=$SCRYER_PATH/metrics
 
 conda activate /home/schudoma/miniconda3/envs/mgscryer_crawler_env
-mkdir -p $SCRYER_LOGS
-python $SCRYER $SCRYER_DB > $SCRYER_LOGS/`date +%Y%m%d-%H_%M`.log
+mkdir -p $SCRYER_LOGS $SCRYER_METRICS
+RUN=`date +%Y%m%d-%H_%M`
+python $SCRYER $SCRYER_DB --metrics-json $SCRYER_LOGS/$RUN.json --metrics-prom $SCRYER_METRICS/mgscryer.prom > $SCRYER_LOGS/$RUN.log
 
 conda activate
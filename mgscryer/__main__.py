@@ -1,14 +1,23 @@
 from datetime import datetime
+import argparse
 import json
 import subprocess
-import urllib
+import threading
+import urllib.parse
 
-import urllib3
 import sqlite3
 
+import http_client
+import metrics
+from db_helpers import MAX_SQL_VARIABLES, chunked
+from metrics import METRICS
+from page_fetcher import PageFetcher
+
 APIBASE="https://www.ebi.ac.uk/metagenomics/api/latest"
 BIOME_LINEAGES = ["root:Host-associated:Human", "root:Host-associated:Mammals"]
 DATABASE_PATH = "/home/schudoma/mgscryer/sqlite/mgscryer.sqlite"
+PAGE_SIZE = 250
+BATCH_SIZE = 500
 
 STUDY_COLUMNS = (
     "id", "bioproject", "accession", "samples_count", "secondary_accession",
@@ -16,19 +25,20 @@ STUDY_COLUMNS = (
     "data_origination", "last_update", "status"
 )
 
-def check_study_exists(study_id, cursor):
-    cmd = "SELECT * FROM study WHERE id = ?;"
-    cursor.execute(cmd, (study_id,))
-    rows = cursor.fetchall()
-    return rows
-    
-    
+WATERMARK_TABLE = """CREATE TABLE IF NOT EXISTS lineage_watermark(
+    lineage TEXT PRIMARY KEY,
+    last_update TEXT
+);"""
 
-def insert_study_record(record, cursor):
-    study_id = record["id"]
-    attributes = record["attributes"]
+STUDY_LINEAGE_TABLE = """CREATE TABLE IF NOT EXISTS study_lineage(
+    study_id TEXT NOT NULL,
+    lineage TEXT NOT NULL,
+    PRIMARY KEY (study_id, lineage)
+);"""
 
-    values = (
+def get_study_values(record):
+    attributes = record["attributes"]
+    return (
         record["id"],
         attributes["bioproject"],
         attributes["accession"],
@@ -44,95 +54,168 @@ def insert_study_record(record, cursor):
         0
     )
 
-    existing_record = check_study_exists(study_id, cursor)
-
-    if existing_record:
-        existing_record = existing_record[0]
-        print("Study {id} is already known".format(id=study_id))
-        #message = "Study {id} has an update.".format(id=record["id"])
-        #p = subprocess.check_output("echo {message} | mailx -s 'mgscryer-update for {id}' christian.schudoma@embl.de".format(message=message, id=record["id"]), shell=True)
-        update_cols, update_vals = list(), list()
-        for col, old_value, new_value in zip(STUDY_COLUMNS, existing_record, values):
-            if old_value != new_value:
-                update_cols.append(col)
-                update_vals.append(new_value)
-        if update_cols:
-            update_ops = ", ".join(["{col} = ?".format(col=col) for col in update_cols])
-            cmd = "UPDATE study SET {update_ops} WHERE id = ?;".format(update_ops=update_ops)
-            cursor.execute(cmd, update_vals + [study_id])
-            return existing_record, values 
-
-    else:
-        cmd = "INSERT INTO study VALUES ({value_placeholders})"
-        res = cursor.execute(cmd.format(value_placeholders=",".join("?" for f in values)), values)
-        for row in res:
-            print(row)
-        return None, values
-
-    return None, None
-        
-
-
-def process_data_block(n, data, cursor, latest_timestamp):
-    print(n, len(data), "records")
-    for record in data:
-        timestamp = datetime.fromisoformat(record["attributes"]["last-update"])
-        if timestamp > latest_timestamp:
-            existing_record, updated_record = insert_study_record(record, cursor)
-            message = ["Study {id} has an update.".format(id=record["id"])]
-            if existing_record:
-                message.append("existing record:")
-                message.append("\n".join(":".join(item) for item in zip(STUDY_COLUMNS, map(str, existing_record))))
-                message.append("updated record:")
-                message.append("\n".join(":".join(item) for item in zip(STUDY_COLUMNS, map(str, updated_record))))
-            elif updated_record:
-                message.append("new record")
-                message.append("\n".join(":".join(item) for item in zip(STUDY_COLUMNS, map(str, updated_record))))
-            else:
-                return True
-            message = "\n".join(message)
-            print(message)
-            # subprocess.check_output("echo {message} | mailx -s 'mgscryer-update for {id}' christian.schudoma@embl.de".format(message=message, id=record["id"]), shell=True)
-            
-            
+def get_existing_studies(cursor, study_ids):
+    studies = dict()
+    for chunk in chunked(study_ids, MAX_SQL_VARIABLES):
+        cmd = "SELECT * FROM study WHERE id IN ({dummy});".format(dummy=",".join("?" for _ in chunk))
+        cursor.execute(cmd, chunk)
+        studies.update((row[0], row) for row in cursor.fetchall())
+    return studies
+
+def format_study(values):
+    return "\n".join(":".join(item) for item in zip(STUDY_COLUMNS, map(str, values)))
+
+def insert_study_records(records, cursor, lineage=None):
+    """ Inserts new and updates changed studies with one executemany each, returns the update messages. """
+    records = {record["id"]: get_study_values(record) for record in records}
+    if lineage is not None:
+        cursor.executemany("INSERT OR IGNORE INTO study_lineage VALUES (?, ?);", ((study_id, lineage) for study_id in records))
+    existing_records = get_existing_studies(cursor, list(records))
+    new_records, updated_records, messages = list(), list(), list()
+    for study_id, values in records.items():
+        existing_record = existing_records.get(study_id)
+        message = ["Study {id} has an update.".format(id=study_id)]
+        if existing_record is None:
+            new_records.append(values)
+            message.extend(("new record", format_study(values)))
+        elif tuple(existing_record) != values:
+            updated_records.append(values[1:] + (study_id,))
+            message.extend(("existing record:", format_study(existing_record), "updated record:", format_study(values)))
         else:
-            print("Record has timestamp {}, which is not newer than our latest timestamp {}. Nothing new, aborting.".format(timestamp, latest_timestamp))
-            return False
-    return True
+            continue
+        messages.append("\n".join(message))
+
+    METRICS.count_records("study", len(new_records), len(updated_records), len(records) - len(new_records) - len(updated_records))
+    if new_records:
+        cmd = "INSERT INTO study VALUES ({value_placeholders})".format(value_placeholders=",".join("?" for f in STUDY_COLUMNS))
+        cursor.executemany(cmd, new_records)
+    if updated_records:
+        update_ops = ", ".join(["{col} = ?".format(col=col) for col in STUDY_COLUMNS[1:]])
+        cmd = "UPDATE study SET {update_ops} WHERE id = ?;".format(update_ops=update_ops)
+        cursor.executemany(cmd, updated_records)
+    return messages
+
+def get_lineage_last_update(cursor, lineage):
+    """ the newest last_update of the lineage's studies in the db, None if there are none """
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM study_lineage);")
+    if cursor.fetchone()[0]:
+        cursor.execute("SELECT MAX(last_update) FROM study JOIN study_lineage ON study_lineage.study_id = study.id "
+                       "WHERE lineage = ?;", (lineage,))
+    else:
+        # dbs from before the per-lineage syncs, which synced all lineages up to the newest study
+        cursor.execute("SELECT MAX(last_update) FROM study;")
+    return cursor.fetchone()[0]
 
-def get_latest_timestamp(cursor):
-    cursor.execute("SELECT MAX(last_update) FROM study")
+def get_watermark(cursor, lineage):
+    cursor.execute("SELECT last_update FROM lineage_watermark WHERE lineage = ?;", (lineage,))
     rows = cursor.fetchall()
-    return datetime.fromisoformat(rows[0][0]) 
-
-def get_mgnify_studies(db):
-    http = urllib3.PoolManager()
-    conn = sqlite3.connect(db)
-
-    with conn:
-        cursor = conn.cursor()
+    return datetime.fromisoformat(rows[0][0]) if rows else datetime(1900, 1, 1)
+
+def set_watermark(cursor, lineage, last_update):
+    cursor.execute("INSERT INTO lineage_watermark VALUES (?, ?) ON CONFLICT(lineage) DO UPDATE SET last_update = excluded.last_update;",
+                   (lineage, last_update))
+
+def seed_watermarks(cursor, lineages):
+    """ Lineages without a watermark start from the newest of their studies the db already has,
+    all before the first sync writes any study_lineage links. """
+    cursor.execute("BEGIN;")
+    for lineage in lineages:
+        cursor.execute("SELECT 1 FROM lineage_watermark WHERE lineage = ?;", (lineage,))
+        if cursor.fetchone() is None:
+            last_update = get_lineage_last_update(cursor, lineage)
+            if last_update is not None:
+                set_watermark(cursor, lineage, last_update)
+    cursor.execute("COMMIT;")
+
+def iter_lineage_studies(lineage, watermark, page_size=PAGE_SIZE, concurrency=4):
+    """ Yields the studies of a lineage, most recently updated first, down to the watermark. """
+    request_str = "{apibase}/studies?lineage={lineage}&ordering=-last_update&page={page}&page_size={page_size}".format(
+        apibase=APIBASE, lineage=lineage, page="{page}", page_size=page_size)
+    first_page = http_client.get(request_str.format(page=1)).json()
+    npages = first_page["meta"]["pagination"]["pages"]
+
+    def reaches_watermark(data):
+        return bool(data) and datetime.fromisoformat(data[-1]["attributes"]["last-update"]) < watermark
+
+    # the first page that reaches below the watermark is the last one needed, the pages after it aren't requested
+    last_page = 1 if reaches_watermark(first_page["data"]) else npages
+    lock = threading.Lock()
+
+    def fetch_page(offset):
+        nonlocal last_page
+        page = offset // page_size + 1
+        if page == 1:
+            return first_page["data"]
+        if page > last_page:
+            return list()
+        data = http_client.get(request_str.format(page=page)).json()["data"]
+        if reaches_watermark(data):
+            with lock:
+                last_page = min(last_page, page)
+        return data
+
+    for record in PageFetcher(fetch_page, page_size, concurrency=concurrency):
+        # >= rather than >, studies updated in the same second as the watermark may not have been seen yet
+        if datetime.fromisoformat(record["attributes"]["last-update"]) < watermark:
+            break
+        yield record
+
+def sync_lineage(cursor, lineage, page_size=PAGE_SIZE, concurrency=4, batch_size=BATCH_SIZE):
+    watermark = get_watermark(cursor, lineage)
+    new_watermark = None
+    n_records = 0
+    for batch in chunked(iter_lineage_studies(lineage, watermark, page_size=page_size, concurrency=concurrency), batch_size):
+        # pages are sorted by last update, the very first record holds the newest timestamp at crawl start
+        if new_watermark is None:
+            new_watermark = batch[0]["attributes"]["last-update"]
+        cursor.execute("BEGIN;")
         try:
-            latest_timestamp = get_latest_timestamp(cursor)
+            with METRICS.timer("db_seconds", table="study"):
+                messages = insert_study_records(batch, cursor, lineage=lineage)
         except:
-            latest_timestamp = datetime(1900,1,1)
+            cursor.execute("ROLLBACK;")
+            raise
+        cursor.execute("COMMIT;")
+        n_records += len(batch)
+        for message in messages:
+            print(message)
 
+    # only advance the watermark once the whole lineage has been written
+    if new_watermark is not None:
+        cursor.execute("BEGIN;")
+        set_watermark(cursor, lineage, new_watermark)
+        cursor.execute("COMMIT;")
+    print("{lineage}: {n} records not older than {watermark}".format(lineage=lineage, n=n_records, watermark=watermark))
+
+def get_mgnify_studies(db, page_size=PAGE_SIZE, concurrency=4, batch_size=BATCH_SIZE):
+    conn = sqlite3.connect(db, isolation_level=None)
+    cursor = conn.cursor()
+    cursor.execute(WATERMARK_TABLE)
+    cursor.execute(STUDY_LINEAGE_TABLE)
+    try:
+        seed_watermarks(cursor, BIOME_LINEAGES)
         for lineage in BIOME_LINEAGES:
-            request_str = "{apibase}/studies?lineage={lineage}&page={page}&page_size=100".format(apibase=APIBASE, lineage=lineage, page="{page}")
-            request = http.request("GET", request_str.format(page=1))
-            page_data = json.loads(request.data)
-            npages = page_data["meta"]["pagination"]["pages"]
-
-            data = page_data
-            for page in range(1, npages + 1):
-                if page > 1:
-                    data = json.loads(http.request("GET", request_str.format(page=page)).data)
-                has_unknown_records = process_data_block(page, data["data"], cursor, latest_timestamp)
-                if not has_unknown_records:
-                    break
+            sync_lineage(cursor, lineage, page_size=page_size, concurrency=concurrency, batch_size=batch_size)
+    finally:
+        conn.close()
 
 
 def main():
-    get_mgnify_studies(DATABASE_PATH)
+    ap = argparse.ArgumentParser()
+    ap.add_argument("db", nargs="?", default=DATABASE_PATH)
+    ap.add_argument("--page-size", type=int, default=PAGE_SIZE)
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="studies per transaction")
+    ap.add_argument("--requests-per-second", type=float, default=10)
+    metrics.add_arguments(ap)
+    args = ap.parse_args()
+
+    http_client.set_rate_limit(urllib.parse.urlsplit(APIBASE).netloc, args.requests_per_second)
+
+    try:
+        get_mgnify_studies(args.db, page_size=args.page_size, concurrency=args.concurrency, batch_size=args.batch_size)
+    finally:
+        metrics.write_report(args, "mgnify")
 
 
 
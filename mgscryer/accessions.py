@@ -0,0 +1,117 @@
+import re
+
+ACCESSION_PATTERN = re.compile(r"^([A-Za-z]+)([0-9]+)$")
+
+
+def split_accession(accession):
+    """ ERR0012345 -> ("ERR", 7, 12345); None for accessions that don't follow prefix+digits """
+    match = ACCESSION_PATTERN.match(accession)
+    if match is None:
+        return None
+    prefix, digits = match.groups()
+    return prefix, len(digits), int(digits)
+
+
+class AccessionSet:
+    """ Set of accessions stored as one bitmap per (prefix, width),
+    i.e. one bit per possible accession number instead of one str object per member. """
+    def __init__(self, accessions=()):
+        self.bitmaps = dict()
+        self.other = set()
+        self.n = 0
+        for accession in accessions:
+            self.add(accession)
+    def add(self, accession):
+        key = split_accession(accession)
+        if key is None:
+            if accession not in self.other:
+                self.other.add(accession)
+                self.n += 1
+            return
+        prefix, width, number = key
+        bitmap = self.bitmaps.setdefault((prefix, width), bytearray())
+        byte, bit = divmod(number, 8)
+        if byte >= len(bitmap):
+            bitmap.extend(bytes(max(byte + 1, 2 * len(bitmap)) - len(bitmap)))
+        if not bitmap[byte] & (1 << bit):
+            bitmap[byte] |= 1 << bit
+            self.n += 1
+    def __contains__(self, accession):
+        key = split_accession(accession)
+        if key is None:
+            return accession in self.other
+        prefix, width, number = key
+        bitmap = self.bitmaps.get((prefix, width))
+        byte, bit = divmod(number, 8)
+        return bitmap is not None and byte < len(bitmap) and bool(bitmap[byte] & (1 << bit))
+    def __len__(self):
+        return self.n
+
+
+class AccessionRange:
+    """ Inclusive range of accessions like ERR1000000-ERR1099999, stored as prefix, zero-padded width and integer bounds. """
+    def __init__(self, prefix, width, start, end):
+        self.prefix = prefix
+        self.width = width
+        self.start = start
+        self.end = end
+    @classmethod
+    def parse(cls, text):
+        """ "ERR1-ERR3" or "ERR1" -> AccessionRange (padded to the width of the first bound); None if the bounds don't share a prefix """
+        first, _, last = text.strip().partition("-")
+        first = split_accession(first)
+        last = split_accession(last) if last else first
+        if first is None or last is None or first[0] != last[0]:
+            return None
+        return cls(first[0], first[1], first[2], last[2])
+    def format(self, number):
+        return "{prefix}{number:0{width}d}".format(prefix=self.prefix, number=number, width=self.width)
+    def __iter__(self):
+        for number in range(self.start, self.end + 1):
+            yield self.format(number)
+    def __contains__(self, accession):
+        key = split_accession(accession)
+        return key is not None and key[0] == self.prefix and self.start <= key[2] <= self.end and self.format(key[2]) == accession
+    def __len__(self):
+        return max(0, self.end - self.start + 1)
+    def __str__(self):
+        if self.start == self.end:
+            return self.format(self.start)
+        return "{}-{}".format(self.format(self.start), self.format(self.end))
+    def __repr__(self):
+        return "AccessionRange({!r})".format(str(self))
+
+
+class AccessionRanges:
+    """ Comma-separated xref ids ("ERS1-ERS3,ERS7") as a list of AccessionRange,
+    ids that aren't prefix+digits are kept as they are. """
+    def __init__(self, ids=""):
+        self.ranges = list()
+        self.other = list()
+        for item in ids.split(","):
+            if not item.strip():
+                continue
+            accession_range = AccessionRange.parse(item)
+            if accession_range is None:
+                self.other.append(item.strip())
+            else:
+                self.ranges.append(accession_range)
+    def __iter__(self):
+        for accession_range in self.ranges:
+            yield from accession_range
+        yield from self.other
+    def __contains__(self, accession):
+        return accession in self.other or any(accession in accession_range for accession_range in self.ranges)
+    def __len__(self):
+        return sum(map(len, self.ranges)) + len(self.other)
+    def __str__(self):
+        return ",".join(list(map(str, self.ranges)) + self.other)
+    def query_strings(self):
+        """ one query per range """
+        return list(map(str, self.ranges)) + self.other
+    def select(self, entities):
+        """ {accession: entity} restricted to the accessions in these ranges,
+        walking whichever of the two is smaller """
+        if len(self) <= len(entities):
+            return {accession: entities[accession] for accession in self if accession in entities}
+        return {accession: entity for accession, entity in entities.items() if accession in self}
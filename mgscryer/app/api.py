@@ -0,0 +1,198 @@
+import json
+
+from flask import Blueprint, Response, abort, current_app, request
+
+from changes import ENTITIES, get_closed_crawl_id, iter_changes
+from migrations import connect
+from search import SearchQueryError, search as search_studies
+from study_summary import RUN_TYPE_COLUMNS, SAMPLE_TYPE_COLUMNS
+
+api = Blueprint("api", __name__, url_prefix="/api")
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# filters that can be applied to a listing, as (request arg, sql condition) per entity
+RUN_FILTERS = (
+    ("library_strategy", "run.library_strategy = ?"),
+    ("instrument_model", "run.instrument_model = ?"),
+)
+LAST_UPDATED_FILTERS = (
+    ("last_updated_from", "{table}.last_updated >= ?"),
+    ("last_updated_to", "{table}.last_updated <= ?"),
+)
+
+
+def get_page_args():
+    try:
+        limit = int(request.args.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        abort(400, "limit has to be an integer")
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        abort(400, "limit has to be between 1 and {}".format(MAX_PAGE_SIZE))
+    return request.args.get("after", ""), limit
+
+def get_filters(table, run_filter=None):
+    where, params = list(), list()
+    for arg, condition in LAST_UPDATED_FILTERS:
+        value = request.args.get(arg)
+        if value:
+            where.append(condition.format(table=table))
+            params.append(value)
+    run_conditions = list()
+    for arg, condition in RUN_FILTERS:
+        value = request.args.get(arg)
+        if value:
+            run_conditions.append(condition)
+            params.append(value)
+    if run_conditions:
+        if run_filter is None:
+            where.extend(run_conditions)
+        else:
+            # studies and samples match if any of their runs match
+            where.append(run_filter.format(conditions=" AND ".join(run_conditions)))
+    return where, params
+
+def stream_page(query, params, limit):
+    """ Streams {"data": [...], "next": <accession or null>} with rows keyed by column name.
+    The last accession of a full page is the cursor for the next page (?after=...). """
+    db = current_app.config["DATABASE_PATH"]
+
+    def generate():
+        conn = connect(db)
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params + [limit])
+            columns = [d[0] for d in cursor.description]
+            yield '{"data": ['
+            n_rows, last_accession = 0, None
+            for row in cursor:
+                yield ("," if n_rows else "") + json.dumps(dict(zip(columns, row)))
+                n_rows, last_accession = n_rows + 1, row[0]
+            yield '], "next": {}}}'.format(json.dumps(last_accession if n_rows == limit else None))
+        finally:
+            conn.close()
+
+    return Response(generate(), mimetype="application/json")
+
+
+@api.route("/studies")
+def studies():
+    after, limit = get_page_args()
+    where, params = get_filters(
+        "study",
+        run_filter="EXISTS (SELECT 1 FROM sample JOIN run ON run.sample_accession = sample.sample_accession "
+                   "WHERE sample.study_accession = study.study_accession AND {conditions})"
+    )
+    tax_tree = request.args.get("tax_tree")
+    if tax_tree:
+        where.insert(0, "study.study_accession IN (SELECT study_accession FROM study_taxtree WHERE tax_tree = ?)")
+        params.insert(0, tax_tree)
+    query = """
+    SELECT study.*, COALESCE(study_summary.n_samples, 0) AS n_samples, COALESCE(study_summary.n_runs, 0) AS n_runs
+    FROM study
+    LEFT JOIN study_summary ON study_summary.study_accession = study.study_accession
+    WHERE {where}
+    ORDER BY study.study_accession
+    LIMIT ?;
+    """.strip().format(where=" AND ".join(["study.study_accession > ?"] + where))
+    return stream_page(query, [after] + params, limit)
+
+@api.route("/studies/<study_accession>/summary")
+def study_summary(study_accession):
+    """ sample and run counts of a study, by sample type and by sample and run type """
+    conn = connect(current_app.config["DATABASE_PATH"])
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT n_samples, n_runs FROM study_summary WHERE study_accession = ?;", (study_accession,))
+        counts = cursor.fetchone()
+        if counts is None:
+            cursor.execute("SELECT 1 FROM study WHERE study_accession = ?;", (study_accession,))
+            if cursor.fetchone() is None:
+                abort(404)
+            counts = 0, 0
+        summary = {"study_accession": study_accession, "n_samples": counts[0], "n_runs": counts[1]}
+        for key, table, columns, count in (("sample_types", "study_sample_type", SAMPLE_TYPE_COLUMNS, "n_samples"),
+                                           ("run_types", "study_run_type", SAMPLE_TYPE_COLUMNS + RUN_TYPE_COLUMNS, "n_runs")):
+            cursor.execute("SELECT {columns}, {count} FROM {table} WHERE study_accession = ? ORDER BY {columns};".format(
+                columns=", ".join(columns), count=count, table=table), (study_accession,))
+            summary[key] = [dict(zip(columns + (count,), row)) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+    return Response(json.dumps(summary), mimetype="application/json")
+
+@api.route("/studies/<study_accession>/samples")
+def study_samples(study_accession):
+    after, limit = get_page_args()
+    where, params = get_filters(
+        "sample",
+        run_filter="EXISTS (SELECT 1 FROM run WHERE run.sample_accession = sample.sample_accession AND {conditions})"
+    )
+    query = """
+    SELECT sample.*
+    FROM sample
+    WHERE {where}
+    ORDER BY sample.sample_accession
+    LIMIT ?;
+    """.strip().format(where=" AND ".join(["sample.study_accession = ?", "sample.sample_accession > ?"] + where))
+    return stream_page(query, [study_accession, after] + params, limit)
+
+@api.route("/samples/<sample_accession>/runs")
+def sample_runs(sample_accession):
+    after, limit = get_page_args()
+    where, params = get_filters("run")
+    query = """
+    SELECT run.*
+    FROM run
+    WHERE {where}
+    ORDER BY run.run_accession
+    LIMIT ?;
+    """.strip().format(where=" AND ".join(["run.sample_accession = ?", "run.run_accession > ?"] + where))
+    return stream_page(query, [sample_accession, after] + params, limit)
+
+@api.route("/changes")
+def changes():
+    """ Changes of the crawls after ?since=<crawl id>, paged by change_id.
+    "until" is the crawl id to pass as since next time, pass it along as ?until= while paging. """
+    try:
+        since = int(request.args.get("since", 0))
+        until = int(request.args["until"]) if request.args.get("until") else None
+        after = int(request.args.get("after") or 0)
+    except ValueError:
+        abort(400, "since, until and after have to be integers")
+    _, limit = get_page_args()
+    entity = request.args.get("entity")
+    if entity is not None and entity not in ENTITIES:
+        abort(400, "entity has to be one of {}".format(", ".join(ENTITIES)))
+    db = current_app.config["DATABASE_PATH"]
+
+    def generate():
+        conn = connect(db)
+        try:
+            cursor = conn.cursor()
+            closed = get_closed_crawl_id(cursor) if until is None else until
+            yield '{{"until": {}, "data": ['.format(closed)
+            n_rows, last_change = 0, None
+            for change in iter_changes(cursor, since=since, until=closed, entity=entity, after=after, limit=limit):
+                yield ("," if n_rows else "") + json.dumps(change)
+                n_rows, last_change = n_rows + 1, change["change_id"]
+            yield '], "next": {}}}'.format(json.dumps(last_change if n_rows == limit else None))
+        finally:
+            conn.close()
+
+    return Response(generate(), mimetype="application/json")
+
+@api.route("/search")
+def search():
+    """ ?q=<words>: studies with all words in their title or their runs' titles/descriptions, best match first.
+    With ?raw=1, q is an fts5 query. """
+    text = request.args.get("q", "")
+    _, limit = get_page_args()
+    conn = connect(current_app.config["DATABASE_PATH"])
+    try:
+        results = search_studies(conn.cursor(), text, limit=limit, raw=request.args.get("raw") == "1")
+    except SearchQueryError as e:
+        abort(400, str(e))
+    finally:
+        conn.close()
+    return Response(json.dumps({"query": text, "data": results}), mimetype="application/json")
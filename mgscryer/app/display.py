@@ -1,4 +1,7 @@
 import sqlite3
+from itertools import groupby
+
+from study_summary import RUN_TYPE_COLUMNS, SAMPLE_TYPE_COLUMNS
 
 def get_studies(cursor):
     query = """
@@ -7,11 +10,11 @@ def get_studies(cursor):
     LEFT JOIN study_pubmed 
     ON study.study_accession = study_pubmed.study_accession
     LEFT JOIN study_taxtree
-    ON study.study_accession = study_taxtree.study_accession;
+    ON study.study_accession = study_taxtree.study_accession
+    ORDER BY study.study_accession;
     """.strip()
     cursor.execute(query)
-    rows = cursor.fetchall()
-    for row in rows:
+    for row in cursor:
         yield row
 
 def get_study_samples(cursor, study_accession):
@@ -23,9 +26,9 @@ def get_study_samples(cursor, study_accession):
     query = """
     SELECT *
     FROM sample
-    WHERE study_accession = '{}';
-    """.strip().format(study_accession)
-    cursor.execute(query)
+    WHERE study_accession = ?;
+    """.strip()
+    cursor.execute(query, (study_accession,))
     rows = cursor.fetchall()
     samples = dict()
     for sample_data in rows:
@@ -42,9 +45,9 @@ def get_sample_runs(cursor, sample_accession):
     query = """
     SELECT *
     FROM run
-    WHERE sample_accession = '{}';
-    """.strip().format(sample_accession)
-    cursor.execute(query)
+    WHERE sample_accession = ?;
+    """.strip()
+    cursor.execute(query, (sample_accession,))
     rows = cursor.fetchall()
     runs = dict()
     for run_data in rows:
@@ -52,38 +55,78 @@ def get_sample_runs(cursor, sample_accession):
         runs.setdefault(tuple(run_data[2:-3]), list()).append(run_accession)
     return runs
 
+def get_sample_types(cursor):
+    # (study_accession, *sample_type, n_samples)
+    columns = ", ".join(SAMPLE_TYPE_COLUMNS)
+    query = """
+    SELECT study_accession, {columns}, n_samples
+    FROM study_sample_type
+    ORDER BY study_accession, {columns};
+    """.strip().format(columns=columns)
+    cursor.execute(query)
+    for row in cursor:
+        yield row
 
-def display_data(cursor):
-    output = list()
+def get_run_types(cursor):
+    # (study_accession, *sample_type, *run_type, n_runs)
+    columns = ", ".join(SAMPLE_TYPE_COLUMNS + RUN_TYPE_COLUMNS)
+    query = """
+    SELECT study_accession, {columns}, n_runs
+    FROM study_run_type
+    ORDER BY study_accession, {columns};
+    """.strip().format(columns=columns)
+    cursor.execute(query)
+    for row in cursor:
+        yield row
+
+
+class StudyGroups:
+    """ Walks a query result ordered by study_accession alongside the (equally ordered) studies,
+    so that each study's rows are picked up without a query per study. """
+    def __init__(self, rows):
+        self.groups = groupby(rows, key=lambda row: row[0])
+        self._next()
+    def _next(self):
+        study_accession, rows = next(self.groups, (None, ()))
+        self.study_accession, self.rows = study_accession, [row[1:] for row in rows]
+    def get(self, study_accession):
+        while self.study_accession is not None and self.study_accession < study_accession:
+            self._next()
+        if self.study_accession == study_accession:
+            return self.rows
+        return list()
+
+
+def iter_display_data(cursor):
+    conn = cursor.connection
+    sample_types = StudyGroups(get_sample_types(conn.cursor()))
+    run_types = StudyGroups(get_run_types(conn.cursor()))
+    n_sample_cols = len(SAMPLE_TYPE_COLUMNS)
     for study_data in get_studies(cursor):
         study_accession, study_data = study_data[0], study_data[1:]
+        sample_data = [(tuple(row[:-1]), row[-1]) for row in sample_types.get(study_accession)]
+        run_data = dict()
+        for row in run_types.get(study_accession):
+            run_data.setdefault(tuple(row[:n_sample_cols]), list()).append((tuple(row[n_sample_cols:-1]), row[-1]))
+
+        output = list()
         output.append("<div>")
         output.append("<h3>{}</h3>".format(study_accession))
-        sample_data = get_study_samples(cursor, study_accession)
-        n_samples = sum(map(len, sample_data.values()))
-        #print(study_accession, *study_data, n_samples, "samples")
+        n_samples = sum(n for _, n in sample_data)
         output.append("<p>{} {} samples</p>".format(study_data, n_samples))
-        for sample_type, samples in sample_data.items():
-            #n_runs = sum(map(len, run_data.values()))
-            run_data = dict()
-            n_runs = 0
-            for sample_accession in samples:
-                for run_type, runs in get_sample_runs(cursor, sample_accession).items():
-                    run_data.setdefault(run_type, list()).extend(runs)
-                #run_data.append(get_sample_runs(conn.cursor(), sample_accession))
-            n_runs = sum(map(len, run_data.values()))
-            output.append("<ul><li>{} {} samples {} runs<ul>".format(sample_type, len(samples), n_runs))
-
-
-            #print(*sample_type, len(samples), "samples", n_runs, "runs")
-            for run_type, runs in run_data.items():
-                output.append("<li>{} {} runs</li>".format(run_type, len(runs)))
+        for sample_type, n_type_samples in sample_data:
+            runs = run_data.get(sample_type, list())
+            n_runs = sum(n for _, n in runs)
+            output.append("<ul><li>{} {} samples {} runs<ul>".format(sample_type, n_type_samples, n_runs))
+            for run_type, n_type_runs in runs:
+                output.append("<li>{} {} runs</li>".format(run_type, n_type_runs))
             output.append("</ul></li>")
-            #print(*run_type, len(runs))
             output.append("</ul>")
-
         output.append("</div>")
-    return "".join(output)
+        yield "".join(output)
+
+def display_data(cursor):
+    return "".join(iter_display_data(cursor))
     
 if __name__ == "__main__":
     #conn = sqlite3.connect("/home/schudoma/mgscryer/sqlite/ena_portal_db_3.sqlite")
@@ -10,10 +10,53 @@ import sqlite3
 #sys.path.insert(0, "/congo/DB/MGSCRYER/mgscryer_py27_env/lib/python2.7/site-packages")
 sys.path.insert(0, "/congo/DB/MGSCRYER/mgscryer_env/lib/python2.7/site-packages")
 sys.stderr.write(sys.version)
+# shared db code (migrations) lives next to the crawlers
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
 
-from flask import Flask
+from flask import Flask, Response, request
+
+from api import api
+from migrations import connect, open_db
+from page_cache import PageCache, get_crawl_timestamp, make_etag
+
+DATABASE_PATH = os.environ.get("MGSCRYER_DB", "/congo/DB/MGSCRYER/mgscryer_db.sqlite")
 
 app = Flask(__name__)
+app.config["DATABASE_PATH"] = DATABASE_PATH
+app.register_blueprint(api)
+# migrations can fill whole tables, they run once here and not inside a request
+open_db(DATABASE_PATH).close()
+page_cache = PageCache(maxsize=int(os.environ.get("MGSCRYER_CACHE_SIZE", 32)),
+                       cache_dir=os.environ.get("MGSCRYER_CACHE_DIR"))
+
+
+def cached_page(generate, mimetype="text/html"):
+    # pages only change when a crawl or a rebuild finishes, so its timestamp is a good enough etag
+    conn = sqlite3.connect(DATABASE_PATH)
+    try:
+        timestamp = get_crawl_timestamp(conn.cursor())
+    finally:
+        conn.close()
+    key = request.full_path
+    etag = make_etag(key, timestamp)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        content = page_cache.get(key, etag)
+        if content is None:
+            response = Response(cache_while_streaming(key, etag, generate()), mimetype=mimetype)
+        else:
+            response = Response(content, mimetype=mimetype)
+    response.set_etag(etag)
+    return response
+
+def cache_while_streaming(key, etag, chunks):
+    content = list()
+    for chunk in chunks:
+        content.append(chunk)
+        yield chunk
+    # only complete pages make it into the cache
+    page_cache.set(key, etag, "".join(content))
 
 @app.route("/")
 def hiya():
@@ -21,17 +64,21 @@ def hiya():
 
 @app.route("/dbtest")
 def dbtest():
-    from display import display_data
-    db = "/congo/DB/MGSCRYER/mgscryer_db.sqlite"
-    conn = sqlite3.connect(db)
-    cursor = conn.cursor()
+    from display import iter_display_data
+
+    # the page is streamed, so the connection has to live as long as the generator
+    def generate():
+        conn = connect(DATABASE_PATH)
+        try:
+            for chunk in iter_display_data(conn.cursor()):
+                yield chunk
+        finally:
+            conn.close()
 
     #cursor.execute("SELECT COUNT(*) FROM study;")
     #cursor.execute(query)
     #rows = cursor.fetchall()
-    content = display_data(cursor)
-    conn.close()
-    return content
+    return cached_page(generate)
     
 
 
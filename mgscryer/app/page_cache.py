@@ -0,0 +1,63 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+def get_crawl_timestamp(cursor):
+    """ when the last crawl or rebuild finished """
+    cursor.execute("SELECT MAX(date_time) FROM timepoints WHERE action IN ('last_update', 'last_change');")
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def make_etag(key, timestamp):
+    return hashlib.sha1("{}|{}".format(key, timestamp).encode("utf-8")).hexdigest()
+
+
+class PageCache:
+    """ Rendered pages keyed by request path, valid for as long as the etag
+    (i.e. the last crawl timestamp) doesn't change.
+    Keeps the most recently used pages in memory and, optionally, all of them on disk. """
+    def __init__(self, maxsize=32, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+    def _path(self, key):
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".html")
+    def get(self, key, etag):
+        with self.lock:
+            page = self.pages.pop(key, None)
+            if page is not None and page[0] == etag:
+                self.pages[key] = page
+                return page[1]
+        if self.cache_dir:
+            try:
+                with io.open(self._path(key), encoding="utf-8") as cached:
+                    if cached.readline().rstrip("\n") == etag:
+                        content = cached.read()
+                        self._remember(key, etag, content)
+                        return content
+            except IOError:
+                pass
+        return None
+    def _remember(self, key, etag, content):
+        with self.lock:
+            self.pages.pop(key, None)
+            self.pages[key] = (etag, content)
+            while len(self.pages) > self.maxsize:
+                self.pages.popitem(last=False)
+    def set(self, key, etag, content):
+        self._remember(key, etag, content)
+        if self.cache_dir:
+            path = self._path(key)
+            # a temp file of its own, threads may render the same page at the same time
+            fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+            with io.open(fd, "w", encoding="utf-8") as cached:
+                cached.write(u"{}\n".format(etag))
+                cached.write(content)
+            os.rename(tmp_path, path)
@@ -0,0 +1,237 @@
+import json
+from datetime import datetime
+
+from migrations import PRAGMAS
+from study_summary import refresh_studies
+
+STAGING_COLUMNS = [
+    "study_accession", "study_title", "first_public", "last_updated",
+    "sample_accession", "host", "host_body_site", "host_tax_id", "environment_biome",
+    "run_accession", "experiment_title", "description", "instrument_model", "instrument_platform",
+    "library_source", "library_layout", "library_strategy", "nominal_length", "read_count",
+]
+TARGET_TABLES = ("study", "sample", "run", "study_sample", "sample_run")
+# entity: (key, columns besides the key and last_updated), as merged by MERGE_STATEMENTS
+ENTITY_COLUMNS = {
+    "study": ("study_accession", ["study_title", "first_public"]),
+    "sample": ("sample_accession", ["host", "host_body_site", "host_tax_id", "environment_biome", "study_accession"]),
+    "run": ("run_accession", ["experiment_title", "description", "instrument_model", "instrument_platform",
+                              "library_source", "library_layout", "library_strategy", "nominal_length", "read_count",
+                              "sample_accession"]),
+}
+
+# durability only matters once the load is through, a failed load is simply repeated
+BULK_PRAGMAS = [
+    "PRAGMA synchronous = OFF;",
+    "PRAGMA temp_store = MEMORY;",
+    "PRAGMA cache_size = -262144;",
+]
+
+# (reason, condition) - the first matching reason is recorded
+REJECT_CHECKS = [
+    ("missing study_accession", "COALESCE(study_accession, '') = ''"),
+    ("missing sample_accession", "COALESCE(sample_accession, '') = ''"),
+    ("missing run_accession", "COALESCE(run_accession, '') = ''"),
+    ("read_count is not an integer", "read_count GLOB '*[^0-9]*'"),
+    ("nominal_length is not an integer", "nominal_length GLOB '*[^0-9]*'"),
+]
+
+# {source} is a table with STAGING_COLUMNS; rows of a study/sample/run are folded into the one last updated,
+# existing rows are only rewritten by newer records that differ, as in upsert_records
+# (WHERE true: INSERT ... SELECT ... ON CONFLICT needs a WHERE)
+MERGE_STATEMENTS = [
+    """INSERT INTO study (study_accession, study_title, first_public, last_updated)
+    SELECT study_accession, study_title, first_public, MAX(last_updated) FROM {source} WHERE true GROUP BY study_accession
+    ON CONFLICT(study_accession) DO UPDATE SET
+        study_title = excluded.study_title, first_public = excluded.first_public, last_updated = excluded.last_updated
+    WHERE excluded.last_updated > study.last_updated
+        AND (study.study_title, study.first_public, study.last_updated)
+        IS NOT (excluded.study_title, excluded.first_public, excluded.last_updated);""",
+    """INSERT INTO sample (sample_accession, host, host_body_site, host_tax_id, environment_biome, study_accession, last_updated)
+    SELECT sample_accession, host, host_body_site, host_tax_id, environment_biome, study_accession, MAX(last_updated)
+    FROM {source} WHERE true GROUP BY sample_accession
+    ON CONFLICT(sample_accession) DO UPDATE SET
+        host = excluded.host, host_body_site = excluded.host_body_site, host_tax_id = excluded.host_tax_id,
+        environment_biome = excluded.environment_biome, study_accession = excluded.study_accession,
+        last_updated = excluded.last_updated
+    WHERE excluded.last_updated > sample.last_updated
+        AND (sample.host, sample.host_body_site, sample.host_tax_id, sample.environment_biome, sample.study_accession, sample.last_updated)
+        IS NOT (excluded.host, excluded.host_body_site, excluded.host_tax_id, excluded.environment_biome,
+                excluded.study_accession, excluded.last_updated);""",
+    """INSERT INTO run (run_accession, experiment_title, description, instrument_model, instrument_platform,
+                     library_source, library_layout, library_strategy, nominal_length, read_count,
+                     sample_accession, last_updated)
+    SELECT run_accession, experiment_title, description, instrument_model, instrument_platform,
+           library_source, library_layout, library_strategy, nominal_length, read_count,
+           sample_accession, MAX(last_updated)
+    FROM {source} WHERE true GROUP BY run_accession
+    ON CONFLICT(run_accession) DO UPDATE SET
+        experiment_title = excluded.experiment_title, description = excluded.description,
+        instrument_model = excluded.instrument_model, instrument_platform = excluded.instrument_platform,
+        library_source = excluded.library_source, library_layout = excluded.library_layout,
+        library_strategy = excluded.library_strategy, nominal_length = excluded.nominal_length,
+        read_count = excluded.read_count, sample_accession = excluded.sample_accession, last_updated = excluded.last_updated
+    WHERE excluded.last_updated > run.last_updated
+        AND (run.experiment_title, run.description, run.instrument_model, run.instrument_platform, run.library_source,
+             run.library_layout, run.library_strategy, run.nominal_length, run.read_count, run.sample_accession, run.last_updated)
+        IS NOT (excluded.experiment_title, excluded.description, excluded.instrument_model, excluded.instrument_platform,
+                excluded.library_source, excluded.library_layout, excluded.library_strategy, excluded.nominal_length,
+                excluded.read_count, excluded.sample_accession, excluded.last_updated);""",
+    """INSERT INTO study_sample SELECT DISTINCT study_accession, sample_accession FROM {source} WHERE true
+    ON CONFLICT DO NOTHING;""",
+    """INSERT INTO sample_run SELECT DISTINCT sample_accession, run_accession FROM {source} WHERE true
+    ON CONFLICT DO NOTHING;""",
+]
+
+
+def get_secondary_indexes(cursor, tables=TARGET_TABLES):
+    """ [(name, sql), ...] of the explicitly created indexes on tables (not the primary key ones) """
+    cursor.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({dummy});".format(
+        dummy=",".join("?" for _ in tables)), tables)
+    return cursor.fetchall()
+
+def drop_indexes(conn, tables=TARGET_TABLES):
+    # remembered in the db, so that a crashed load can't leave the indexes behind for good
+    cursor = conn.cursor()
+    indexes = get_secondary_indexes(cursor, tables)
+    for name, sql in indexes:
+        cursor.execute("INSERT OR REPLACE INTO bulk_dropped_index VALUES (?, ?);", (name, sql))
+        cursor.execute("DROP INDEX IF EXISTS {name};".format(name=name))
+    conn.commit()
+    return [name for name, _ in indexes]
+
+def restore_indexes(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT name, sql FROM bulk_dropped_index;")
+    indexes = cursor.fetchall()
+    for name, sql in indexes:
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = ?;", (name,))
+        if not cursor.fetchall():
+            cursor.execute(sql)
+        cursor.execute("DELETE FROM bulk_dropped_index WHERE name = ?;", (name,))
+    conn.commit()
+    return [name for name, _ in indexes]
+
+def merge_staging(cursor, source):
+    for statement in MERGE_STATEMENTS:
+        cursor.execute(statement.format(source=source))
+
+def log_staged_changes(cursor, source, crawl_id):
+    """ logs the inserts and updates that merge_staging(cursor, source) is about to make """
+    for entity, (key, columns) in ENTITY_COLUMNS.items():
+        columns = columns + ["last_updated"]
+        changed = " UNION ALL ".join("SELECT '{col}' AS col WHERE target.{col} IS NOT staged.{col}".format(col=col)
+                                     for col in columns)
+        cursor.execute("""INSERT INTO changes (crawl_id, entity, accession, kind, columns)
+        SELECT ?, ?, staged.{key},
+               CASE WHEN target.{key} IS NULL THEN 'insert' ELSE 'update' END,
+               CASE WHEN target.{key} IS NULL THEN NULL ELSE (SELECT json_group_array(col) FROM ({changed})) END
+        FROM (SELECT {key}, {columns}, MAX(last_updated) AS last_updated FROM {source} GROUP BY {key}) AS staged
+        LEFT JOIN {entity} AS target ON target.{key} = staged.{key}
+        WHERE target.{key} IS NULL
+            OR (staged.last_updated > target.last_updated AND ({target_columns}) IS NOT ({staged_columns}));""".format(
+            key=key, entity=entity, source=source, changed=changed, columns=", ".join(columns[:-1]),
+            target_columns=", ".join("target." + col for col in columns),
+            staged_columns=", ".join("staged." + col for col in columns)), (crawl_id, entity))
+
+REJECT_REASON = "CASE {} END".format(" ".join("WHEN {} THEN '{}'".format(condition, reason) for reason, condition in REJECT_CHECKS))
+
+def reject_staging(cursor, source, crawl=None):
+    """ copies the rows of source that fail a REJECT_CHECKS check to load_reject,
+    returns their number and the rows of source that passed, as a subquery """
+    reason = REJECT_REASON
+    record = "json_object({})".format(", ".join("'{col}', {col}".format(col=col) for col in STAGING_COLUMNS))
+    # a NULL count fails none of the checks
+    any_check = "COALESCE({}, false)".format(" OR ".join("({})".format(condition) for _, condition in REJECT_CHECKS))
+    now = datetime.isoformat(datetime.now())
+    cursor.execute("INSERT INTO load_reject SELECT ?, ?, {reason}, {record} FROM {source} WHERE {any_check};".format(
+        reason=reason, record=record, source=source, any_check=any_check), (now, crawl))
+    return cursor.rowcount, "(SELECT * FROM {source} WHERE NOT {any_check})".format(source=source, any_check=any_check)
+
+def get_reject_reason(cursor, record):
+    """ the first REJECT_CHECKS reason a single record fails, or None """
+    cursor.execute("SELECT {reason} FROM (SELECT {columns});".format(
+        reason=REJECT_REASON, columns=", ".join("? AS {}".format(col) for col in STAGING_COLUMNS)),
+        [record.get(col) for col in STAGING_COLUMNS])
+    return cursor.fetchone()[0]
+
+def reject_record(cursor, record, reason, crawl=None):
+    """ the single record counterpart of reject_staging """
+    cursor.execute("INSERT INTO load_reject VALUES (?, ?, ?, ?);", (
+        datetime.isoformat(datetime.now()), crawl, reason, json.dumps({col: record.get(col) for col in STAGING_COLUMNS})))
+
+def get_entity_row(record, entity):
+    """ the row of the study/sample/run table for a portal record, in table column order """
+    key, columns = ENTITY_COLUMNS[entity]
+    row = tuple(record.get(col) for col in [key] + columns + ["last_updated"])
+    # study.status
+    return row + (1,) if entity == "study" else row
+
+class BulkLoader:
+    """ Initial fills: records are collected in a staging table with executemany
+    and merged into study/sample/run/study_sample/sample_run with one statement per table.
+    Secondary indexes are dropped for the duration of the load and rebuilt afterwards,
+    rows that can't be loaded end up in load_reject.
+    flush() does not commit, so that callers can commit their progress with the data.
+    With a crawl_id, the inserted and updated study/sample/run records go to the changes log. """
+    def __init__(self, conn, crawl=None, chunk_size=50000, crawl_id=None):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.crawl = crawl
+        self.crawl_id = crawl_id
+        self.chunk_size = chunk_size
+        self.rows = list()
+        self.n_loaded = 0
+        self.n_rejected = 0
+        # their summaries are refreshed once the indexes are back
+        self.studies = set()
+    def __enter__(self):
+        for pragma in BULK_PRAGMAS:
+            self.conn.execute(pragma)
+        self.dropped = drop_indexes(self.conn)
+        self.cursor.execute("CREATE TEMP TABLE IF NOT EXISTS staging_record ({columns});".format(
+            columns=", ".join(STAGING_COLUMNS)))
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+            self.conn.commit()
+        else:
+            self.conn.rollback()
+        # rebuilt even after a failed load, the merged chunks are committed
+        restore_indexes(self.conn)
+        for table in TARGET_TABLES:
+            self.cursor.execute("ANALYZE {table};".format(table=table))
+        refresh_studies(self.cursor, self.studies)
+        self.conn.commit()
+        for pragma in PRAGMAS:
+            self.conn.execute(pragma)
+        return False
+    def add(self, record):
+        self.rows.append(tuple(record.get(column) for column in STAGING_COLUMNS))
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+    def flush(self):
+        if self.rows:
+            self.cursor.executemany("INSERT INTO staging_record VALUES ({dummy});".format(
+                dummy=",".join("?" for _ in STAGING_COLUMNS)), self.rows)
+            self.rows = list()
+        self.merge("staging_record")
+        self.cursor.execute("DELETE FROM staging_record;")
+    def merge(self, source):
+        """ merges any table with STAGING_COLUMNS, e.g. one of an attached database """
+        n_rejected, accepted = reject_staging(self.cursor, source, crawl=self.crawl)
+        self.n_rejected += n_rejected
+        self.cursor.execute("SELECT COUNT(*) FROM {accepted};".format(accepted=accepted))
+        self.n_loaded += self.cursor.fetchone()[0]
+        # before the merge: samples and runs moved to another study also change the study they leave
+        self.cursor.execute("""SELECT study_accession FROM {accepted}
+        UNION SELECT sample.study_accession FROM {accepted} AS staged
+            JOIN sample ON sample.sample_accession = staged.sample_accession
+        UNION SELECT sample.study_accession FROM {accepted} AS staged
+            JOIN run ON run.run_accession = staged.run_accession
+            JOIN sample ON sample.sample_accession = run.sample_accession;""".format(accepted=accepted))
+        self.studies.update(row[0] for row in self.cursor.fetchall())
+        if self.crawl_id is not None:
+            log_staged_changes(self.cursor, accepted, self.crawl_id)
+        merge_staging(self.cursor, accepted)
@@ -0,0 +1,121 @@
+""" Log of the study/sample/run records each crawl inserted or updated.
+
+A downstream job remembers the crawl id it has processed and only reads what changed since:
+    python changes.py mgscryer_db.sqlite --since 41 > delta.tsv
+The crawl id to pass next time is written to stderr. Changes only become visible once their crawl
+and all crawls before it are closed, so that a consumer can't skip the rest of a crawl still running.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+from datetime import datetime
+
+from migrations import open_db
+
+ENTITIES = ("study", "sample", "run")
+KINDS = ("insert", "update")
+COLUMNS = ("change_id", "crawl_id", "entity", "accession", "kind", "columns")
+
+
+def start_crawl(cursor, crawl, resume=False):
+    """ -> crawl_id of a new crawl, or of the interrupted crawl that is resumed """
+    if resume:
+        cursor.execute("SELECT MAX(crawl_id) FROM crawl_log WHERE crawl = ? AND status = 'running';", (crawl,))
+        crawl_id = cursor.fetchone()[0]
+        if crawl_id is not None:
+            return crawl_id
+    now = datetime.isoformat(datetime.now())
+    # interrupted crawls that weren't resumed won't finish anymore, don't let them hold back the later ones
+    cursor.execute("UPDATE crawl_log SET status = 'aborted', finished = ? WHERE crawl = ? AND status = 'running';",
+                   (now, crawl))
+    cursor.execute("INSERT INTO crawl_log (crawl, started) VALUES (?, ?);", (crawl, now))
+    return cursor.lastrowid
+
+def finish_crawl(cursor, crawl_id):
+    cursor.execute("UPDATE crawl_log SET status = 'finished', finished = ? WHERE crawl_id = ?;",
+                   (datetime.isoformat(datetime.now()), crawl_id))
+    set_last_change(cursor)
+
+def set_last_change(cursor):
+    """ marks the db contents as changed, the app's cached pages go stale with it.
+    Not the portal's 'last_update', that is where its next crawl starts from. """
+    cursor.execute("INSERT OR REPLACE INTO timepoints (action, date_time) VALUES ('last_change', ?);",
+                   (datetime.isoformat(datetime.now()),))
+
+def log_changes(cursor, crawl_id, entity, changes):
+    """ changes: (accession, kind, changed columns or None) """
+    cursor.executemany(
+        "INSERT INTO changes (crawl_id, entity, accession, kind, columns) VALUES (?, ?, ?, ?, ?);",
+        ((crawl_id, entity, accession, kind, json.dumps(columns) if columns is not None else None)
+         for accession, kind, columns in changes)
+    )
+
+def get_closed_crawl_id(cursor):
+    """ the highest crawl id up to which no crawl is running anymore (0 if there is none) """
+    cursor.execute("SELECT MIN(crawl_id) FROM crawl_log WHERE status = 'running';")
+    running = cursor.fetchone()[0]
+    if running is not None:
+        return running - 1
+    cursor.execute("SELECT COALESCE(MAX(crawl_id), 0) FROM crawl_log;")
+    return cursor.fetchone()[0]
+
+def iter_changes(cursor, since=0, until=None, entity=None, after=0, limit=None):
+    """ changes of the crawls since < crawl_id <= until (default: get_closed_crawl_id), in order, as dicts.
+    after/limit page through them by change_id. """
+    if until is None:
+        until = get_closed_crawl_id(cursor)
+    where, params = ["crawl_id > ?", "crawl_id <= ?", "change_id > ?"], [since, until, after]
+    if entity is not None:
+        where.append("entity = ?")
+        params.append(entity)
+    query = "SELECT {columns} FROM changes WHERE {where} ORDER BY change_id".format(
+        columns=", ".join(COLUMNS), where=" AND ".join(where))
+    if limit is not None:
+        query += " LIMIT ?"
+        params.append(limit)
+    cursor.execute(query + ";", params)
+    for row in cursor:
+        change = dict(zip(COLUMNS, row))
+        if change["columns"] is not None:
+            change["columns"] = json.loads(change["columns"])
+        yield change
+
+
+def main():
+    ap = argparse.ArgumentParser(description="list the records that changed since a crawl")
+    ap.add_argument("db")
+    ap.add_argument("--since", type=int, default=0, help="crawl id processed last time (default: everything)")
+    ap.add_argument("--entity", choices=ENTITIES)
+    ap.add_argument("--json", action="store_true", help="one json object per line instead of tsv")
+    ap.add_argument("--crawls", action="store_true", help="list the crawls instead")
+    args = ap.parse_args()
+
+    conn = open_db(args.db)
+    cursor = conn.cursor()
+    if args.crawls:
+        cursor.execute("SELECT crawl_id, crawl, started, finished, status, "
+                       "(SELECT COUNT(*) FROM changes WHERE changes.crawl_id = crawl_log.crawl_id) "
+                       "FROM crawl_log ORDER BY crawl_id;")
+        print("crawl_id", "crawl", "started", "finished", "status", "changes", sep="\t")
+        for row in cursor.fetchall():
+            print(*("" if col is None else col for col in row), sep="\t")
+        conn.close()
+        return
+
+    until = get_closed_crawl_id(cursor)
+    if not args.json:
+        print(*COLUMNS, sep="\t")
+    for change in iter_changes(cursor, since=args.since, until=until, entity=args.entity):
+        if args.json:
+            print(json.dumps(change))
+        else:
+            print(*(",".join(value) if isinstance(value, list) else ("" if value is None else value)
+                    for value in (change[col] for col in COLUMNS)), sep="\t")
+    conn.close()
+    print("changes up to crawl {}, use --since {} next time".format(until, until), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
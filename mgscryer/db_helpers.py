@@ -1,3 +1,5 @@
+from datetime import datetime, timedelta
+
 DEBUG = False
 
 def check_link_exists(cursor, table, field1, field2, id1, id2):
@@ -62,3 +64,95 @@ def update_record(cursor, table, _id, updates):
     if DEBUG:
         for row in res:
             print(row)
+
+# SQLITE_MAX_VARIABLE_NUMBER defaults to 999 on older sqlite builds
+MAX_SQL_VARIABLES = 999
+
+def chunked(items, size):
+    chunk = list()
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = list()
+    if chunk:
+        yield chunk
+
+def get_columns(cursor, table):
+    cursor.execute("SELECT * FROM {table} LIMIT 0;".format(table=table))
+    return [d[0] for d in cursor.description]
+
+def get_last_updated(cursor, table, ids):
+    last_updated = dict()
+    for chunk in chunked(ids, MAX_SQL_VARIABLES):
+        cmd = "SELECT {table}_accession, last_updated FROM {table} WHERE {table}_accession IN ({dummy});".format(
+            table=table, dummy=",".join("?" for _ in chunk))
+        cursor.execute(cmd, chunk)
+        last_updated.update(cursor.fetchall())
+    return last_updated
+
+def get_tax_trees_many(cursor, study_accessions):
+    trees = dict()
+    for chunk in chunked(study_accessions, MAX_SQL_VARIABLES):
+        cmd = "SELECT study_accession, tax_tree FROM study_taxtree WHERE study_accession IN ({dummy});".format(
+            dummy=",".join("?" for _ in chunk))
+        cursor.execute(cmd, chunk)
+        for study_accession, tax_tree in cursor.fetchall():
+            trees.setdefault(study_accession, list()).append(tax_tree)
+    return trees
+
+def upsert_records(cursor, table, records):
+    # only overwrite existing rows if the incoming record is newer
+    columns = get_columns(cursor, table)
+    update_ops = ", ".join("{col} = excluded.{col}".format(col=col) for col in columns[1:])
+    cmd = "INSERT INTO {table} VALUES ({dummy}) " \
+          "ON CONFLICT({key}) DO UPDATE SET {update_ops} " \
+          "WHERE excluded.last_updated > {table}.last_updated;".format(
+        table=table, dummy=",".join("?" for _ in columns), key=columns[0], update_ops=update_ops)
+    if DEBUG:
+        print(cmd)
+    cursor.executemany(cmd, records)
+
+def get_records(cursor, table, ids):
+    records, columns = dict(), None
+    for chunk in chunked(ids, MAX_SQL_VARIABLES):
+        cmd = "SELECT * FROM {table} WHERE {table}_accession IN ({dummy});".format(
+            table=table, dummy=",".join("?" for _ in chunk))
+        cursor.execute(cmd, chunk)
+        columns = [d[0] for d in cursor.description]
+        records.update((row[0], row) for row in cursor.fetchall())
+    return columns, records
+
+def get_stale_pubmed_studies(cursor, studies, max_age):
+    # never checked or last checked more than max_age days ago
+    cutoff = (datetime.now() - timedelta(days=max_age)).isoformat()
+    fresh = set()
+    for chunk in chunked(studies, MAX_SQL_VARIABLES):
+        cmd = "SELECT study_accession FROM study_pubmed_checked WHERE checked >= ? AND study_accession IN ({dummy});".format(
+            dummy=",".join("?" for _ in chunk))
+        cursor.execute(cmd, [cutoff] + chunk)
+        fresh.update(row[0] for row in cursor.fetchall())
+    return set(studies).difference(fresh)
+
+def insert_pubmed_links(cursor, accessions, links):
+    cursor.executemany("INSERT OR IGNORE INTO study_pubmed VALUES (?, ?);", links)
+    now = datetime.isoformat(datetime.now())
+    cursor.executemany("INSERT OR REPLACE INTO study_pubmed_checked VALUES (?, ?);",
+                       ((accession, now) for accession in accessions))
+
+def get_studies_since(cursor, last_updated):
+    cursor.execute("SELECT study_accession FROM study WHERE last_updated >= ?;", (last_updated,))
+    return {row[0] for row in cursor.fetchall()}
+
+def get_checkpoints(cursor, crawl):
+    """ {tax_tree: (watermark, offset, done)} """
+    cursor.execute("SELECT tax_tree, watermark, offset, done FROM crawl_checkpoint WHERE crawl = ?;", (crawl,))
+    return {tax_tree: (watermark, offset, bool(done)) for tax_tree, watermark, offset, done in cursor.fetchall()}
+
+def set_checkpoint(cursor, crawl, tax_tree, watermark, offset, done=False):
+    now = datetime.isoformat(datetime.now())
+    cursor.execute("INSERT OR REPLACE INTO crawl_checkpoint VALUES (?, ?, ?, ?, ?, ?);",
+                   (crawl, tax_tree, watermark, offset, int(done), now))
+
+def clear_checkpoints(cursor, crawl):
+    cursor.execute("DELETE FROM crawl_checkpoint WHERE crawl = ?;", (crawl,))
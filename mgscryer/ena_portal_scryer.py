@@ -6,12 +6,29 @@ import urllib.parse
 import argparse
 import sqlite3
 import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 from bs4 import BeautifulSoup
-import requests
 
+import http_client
 from db_helpers import check_record_exists, insert_record, update_record, check_link_exists, update_tax_trees, check_tax_trees
+from db_helpers import chunked, get_last_updated, get_records, get_tax_trees_many, upsert_records
+from db_helpers import get_stale_pubmed_studies, insert_pubmed_links
+from db_helpers import get_checkpoints, set_checkpoint, clear_checkpoints, get_studies_since
+import metrics
+from accessions import AccessionSet
+from changes import finish_crawl, log_changes, start_crawl
+from migrations import open_db
+from page_fetcher import PageFetcher
+from portal_stream import PortalResponseError, stream_tsv_records
 from pubmed import PubmedQuery
+from ratelimit import TokenBucket
+from metrics import METRICS
+from snapshot import LastUpdatedSnapshot
+from study_summary import refresh_studies
 
 DEBUG = False
 
@@ -25,7 +42,9 @@ BASE_QUERY = "instrument_platform=%22ILLUMINA%22" \
              "OR%20(library_strategy=%22RNA-Seq%22%20AND%20library_source=%22METATRANSCRIPTOMIC%22))" \
              "{sub_query}&limit={limit}&offset={{offset}}"
 
-MAIN_QUERY = f"search?result=read_run&includeMetagenomes=1&format=json&fields={','.join(FIELDS)}&query={BASE_QUERY}"
+CHECKPOINT_CRAWL = "portal"
+
+MAIN_QUERY = f"search?result=read_run&includeMetagenomes=1&format={{response_format}}&fields={','.join(FIELDS)}&query={BASE_QUERY}"
 
 def get_tax_trees(cursor):
     cursor.execute("SELECT * FROM tax_trees;")
@@ -59,7 +78,7 @@ def process_updates(cursor, table, record):
         insert_record(cursor, table, record)
     elif updates:
         update_record(cursor, table, record[0], updates)
-    return not existing_record, bool(updates)
+    return not existing_record, bool(updates), dict(existing_record)
 
 
 class Entity:
@@ -70,14 +89,15 @@ class Entity:
     def to_tuple(self):
         return tuple(getattr(self, field) for field in self.FIELDS)    
     def update_db(self, cursor):
+        """ -> (new_record, updated_record, the db row before the update as a dict) """
         whatami = self.__class__.__name__.lower()
         try:
-            new_record, updated_record = process_updates(cursor, whatami, self.to_tuple())
+            new_record, updated_record, previous = process_updates(cursor, whatami, self.to_tuple())
         except Exception as e:
             print(e)
             print(f"Couldn't update {whatami}:", self.to_tuple(), file=sys.stderr, flush=True)
-            new_record, updated_record = False, False
-        return new_record, updated_record
+            new_record, updated_record, previous = False, False, dict()
+        return new_record, updated_record, previous
 
 class Study(Entity):
     FIELDS = ["study_accession", "study_title", "first_public", "last_updated"]
@@ -99,6 +119,19 @@ class Run(Entity):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
+class CrawlTaxTreeLinks:
+    """ Parallel crawls see the tax trees in arbitrary order. Remembering the study <-> tax_tree
+    links inserted during the crawl lets a tree that comes earlier in tax_trees order take
+    the study over, so the final links are the same as after a sequential crawl. """
+    def __init__(self, tax_trees):
+        self.ranks = {int(tax_tree): i for i, (tax_tree, _) in enumerate(tax_trees)}
+        self.links = dict()
+    def add(self, study_accession, tax_tree):
+        self.links[study_accession] = tax_tree
+    def takes_over(self, study_accession, tax_tree):
+        current = self.links.get(study_accession)
+        return current is not None and self.ranks[tax_tree] < self.ranks[current]
+
 class Record:
     FIELDS = ["study", "sample", "run"]
     def __init__(self, **kwargs):
@@ -106,12 +139,19 @@ class Record:
         self.sample = Sample(**kwargs)
         self.run = Run(**kwargs)
         self.record_states = dict()
+        self.record_updates = dict()
+        # current db rows of the updated entities, before the update
+        self.previous = dict()
 
-    def update_db(self, cursor, tax_tree=None):
+    def update_db(self, cursor, tax_tree=None, entities=True):
+        """ entities=False only checks the study <-> tax_tree link """
         for field in Record.FIELDS:
             entity = getattr(self, field)
-            new_record, updated_record = entity.update_db(cursor)
-            self.record_states[field] = (new_record, updated_record)
+            if entities:
+                new_record, updated_record, previous = entity.update_db(cursor)
+                self.record_states[field] = (new_record, updated_record)
+                if updated_record:
+                    self.previous[field] = previous
             if field == "study":
                 trees = check_tax_trees(cursor, entity.study_accession) 
                 if trees:
@@ -125,46 +165,394 @@ class Record:
                         print(e)
                         print(f"Couldn't insert tax_tree link: {entity.study_accession} <-> {tax_tree}")
 
+    @staticmethod
+    def update_db_many(cursor, records, tax_tree=None, crawl_links=None, seen_runs=None, snapshots=None, checkpoint=None,
+                       crawl_id=None, touched_studies=None):
+        """ With touched_studies, the studies whose summaries need a refresh are added to it
+        instead of being refreshed right away. """
+        # runs already written during this crawl (e.g. under another tax tree)
+        # only need their study <-> tax_tree link checked
+        fresh_records, fresh_runs = list(), set()
+        for record in records:
+            run_accession = record.run.run_accession
+            if (seen_runs is not None and run_accession in seen_runs) or run_accession in fresh_runs:
+                record.record_states = {field: (False, False) for field in Record.FIELDS}
+            else:
+                fresh_records.append(record)
+                fresh_runs.add(run_accession)
+        written = dict()
+        cursor.execute("BEGIN;")
+        try:
+            for field in Record.FIELDS:
+                snapshot = snapshots.get(field) if snapshots else None
+                with METRICS.timer("db_seconds", table=field):
+                    written[field] = Record._upsert_entities(cursor, field, fresh_records, snapshot=snapshot)
+            with METRICS.timer("db_seconds", table="study_taxtree"):
+                Record._update_tax_trees_many(cursor, records, tax_tree, crawl_links=crawl_links)
+            if crawl_id is not None:
+                Record._log_changes(cursor, fresh_records, crawl_id)
+            Record._refresh_summaries(cursor, fresh_records, touched_studies=touched_studies)
+            if checkpoint is not None:
+                checkpoint(cursor)
+        except sqlite3.Error as e:
+            cursor.execute("ROLLBACK;")
+            print(e)
+            print(f"Couldn't batch-update {len(records)} records, falling back to single updates.", file=sys.stderr, flush=True)
+            fresh = set(map(id, fresh_records))
+            for record in records:
+                # runs seen before, in this batch or earlier in the crawl, keep their (False, False) states
+                record.update_db(cursor, tax_tree=tax_tree, entities=id(record) in fresh)
+            for field in Record.FIELDS:
+                written[field] = {getattr(record, field).to_tuple()[0]: getattr(record, field).last_updated
+                                  for record in fresh_records if any(record.record_states[field])}
+            if crawl_id is not None:
+                Record._log_changes(cursor, fresh_records, crawl_id)
+            Record._refresh_summaries(cursor, fresh_records, touched_studies=touched_studies)
+            if checkpoint is not None:
+                checkpoint(cursor)
+        else:
+            with METRICS.timer("db_seconds", table="commit"):
+                cursor.execute("COMMIT;")
+        if snapshots:
+            for field, last_updated in written.items():
+                for accession, timestamp in last_updated.items():
+                    snapshots[field][accession] = timestamp
+        if seen_runs is not None:
+            for run_accession in fresh_runs:
+                seen_runs.add(run_accession)
+        Record._count_states(records)
+
+    @staticmethod
+    def _count_states(records):
+        for field in Record.FIELDS:
+            states = dict()
+            for record in records:
+                states.setdefault(getattr(record, field).to_tuple()[0], record.record_states[field])
+            new = sum(1 for state in states.values() if state[0])
+            updated = sum(1 for state in states.values() if not state[0] and state[1])
+            METRICS.count_records(field, new, updated, len(states) - new - updated)
+
+    @staticmethod
+    def _log_changes(cursor, records, crawl_id):
+        for field in Record.FIELDS:
+            changes = dict()
+            for record in records:
+                new_record, updated_record = record.record_states[field]
+                accession = getattr(record, field).to_tuple()[0]
+                if (new_record or updated_record) and accession not in changes:
+                    # single updates (the fallback) don't keep their column diff
+                    updates = record.record_updates.get(field)
+                    columns = None if new_record or updates is None else [col for col, _ in updates]
+                    changes[accession] = accession, "insert" if new_record else "update", columns
+            log_changes(cursor, crawl_id, field, changes.values())
+
+    @staticmethod
+    def _refresh_summaries(cursor, records, touched_studies=None):
+        # a sample or run moved to another study also changes the study it was moved from
+        studies, old_samples = set(), set()
+        for record in records:
+            if any(record.record_states[field][0] or record.record_states[field][1] for field in Record.FIELDS):
+                studies.add(record.sample.study_accession)
+                studies.add(record.previous.get("sample", dict()).get("study_accession"))
+                old_samples.add(record.previous.get("run", dict()).get("sample_accession"))
+        old_samples.discard(None)
+        if old_samples:
+            columns, samples = get_records(cursor, "sample", old_samples)
+            studies.update(row[columns.index("study_accession")] for row in samples.values())
+        studies.discard(None)
+        if touched_studies is not None:
+            touched_studies.update(studies)
+            return
+        with METRICS.timer("db_seconds", table="study_summary"):
+            refresh_studies(cursor, studies)
+
+    @staticmethod
+    def _upsert_entities(cursor, field, records, snapshot=None):
+        # replay the per-row insert/update decisions in memory,
+        # so that record_states match what update_db would have reported
+        accessions = {getattr(record, field).to_tuple()[0] for record in records}
+        if snapshot is None:
+            current = get_last_updated(cursor, field, accessions)
+        else:
+            current = {accession: snapshot[accession] for accession in accessions if accession in snapshot}
+        existing = set(current)
+        rows = dict()
+        for record in records:
+            entity = getattr(record, field)
+            row = entity.to_tuple()
+            accession, last_updated = row[0], entity.last_updated
+            if accession not in current:
+                state = True, False
+            else:
+                cur_updated = current[accession]
+                state = False, last_updated is not None and cur_updated is not None and last_updated > cur_updated
+            if state[0] or state[1]:
+                current[accession] = last_updated
+                rows[accession] = row
+            record.record_states[field] = state
+
+        # only records that changed need their current db row for a column diff
+        updated = existing.intersection(rows)
+        if updated:
+            columns, existing_rows = get_records(cursor, field, updated)
+            for record in records:
+                row = getattr(record, field).to_tuple()
+                if record.record_states[field][1] and row[0] in existing_rows:
+                    record.record_updates[field] = [(col, new_col)
+                                                    for col, cur_col, new_col in zip(columns, existing_rows[row[0]], row)
+                                                    if new_col != cur_col]
+                    record.previous[field] = dict(zip(columns, existing_rows[row[0]]))
+        upsert_records(cursor, field, rows.values())
+        return {accession: current[accession] for accession in rows}
+
+    @staticmethod
+    def _update_tax_trees_many(cursor, records, tax_tree, crawl_links=None):
+        tax_tree = int(tax_tree)
+        study_trees = get_tax_trees_many(cursor, {record.study.study_accession for record in records})
+        new_links, updated_links = list(), list()
+        for record in records:
+            study_accession = record.study.study_accession
+            trees = study_trees.get(study_accession)
+            if trees:
+                if 9606 in map(int, trees):
+                    continue
+                if tax_tree == 9606 or (crawl_links is not None and crawl_links.takes_over(study_accession, tax_tree)):
+                    updated_links.append((tax_tree, study_accession))
+                    study_trees[study_accession] = [tax_tree]
+                    if crawl_links is not None:
+                        crawl_links.add(study_accession, tax_tree)
+            else:
+                new_links.append((study_accession, tax_tree))
+                study_trees[study_accession] = [tax_tree]
+                if crawl_links is not None:
+                    crawl_links.add(study_accession, tax_tree)
+        cursor.executemany("INSERT INTO study_taxtree VALUES (?, ?);", new_links)
+        cursor.executemany("UPDATE study_taxtree SET tax_tree = ? WHERE study_accession = ?;", updated_links)
+
 class EnaPortalScryer:
-    def __init__(self, db, base_url=BASE_API_URL, query=MAIN_QUERY, sub_query="", limit=1000, sleep_interval=0.1):
+    def __init__(self, db, base_url=BASE_API_URL, query=MAIN_QUERY, sub_query="", limit=1000, sleep_interval=0.1, batch_size=1000,
+                 concurrency=1, requests_per_second=None, parallel_trees=False, queue_size=16, stream=False,
+                 preload=True, pubmed_max_age=30, resume=False):
         self.base_url = base_url
         self.query = query
         self.offset = 0
         self.limit = limit
-        self.conn = sqlite3.connect(db, isolation_level=None)
+        self.conn = open_db(db, isolation_level=None)
         self._get_last_update()
         self.sleep_interval = sleep_interval
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.requests_per_second = requests_per_second
+        if requests_per_second is None and sleep_interval:
+            self.requests_per_second = 1 / sleep_interval
+        # one request budget for all trees crawled in parallel
+        self.bucket = TokenBucket(self.requests_per_second)
+        self.parallel_trees = parallel_trees
+        self.queue_size = queue_size
+        self.stream = stream
+        self.seen_runs = AccessionSet()
+        self.preload = preload
+        self.snapshots = None
+        self.pubmed_max_age = pubmed_max_age
+        self.resume = resume
+        self.checkpoints = dict()
+        self.crawl_id = None
+        # summaries are refreshed once per tax tree (or crawl, with parallel trees), not per batch
+        self.touched_studies = set()
     def _get_last_update(self):
         self.last_update = get_last_update(self.conn.cursor())
     def run(self):
         studies = set()
-        limit = self.limit
-        for tax_tree, tax_label in get_tax_trees(self.conn.cursor()):
+        self.seen_runs = AccessionSet()
+        cursor = self.conn.cursor()
+        self.checkpoints = get_checkpoints(cursor, CHECKPOINT_CRAWL) if self.resume else dict()
+        if self.checkpoints:
+            # continue with the watermark the interrupted crawl started from
+            self.last_update = next(iter(self.checkpoints.values()))[0]
+            studies.update(get_studies_since(cursor, self.last_update))
+            # their summaries may not have been refreshed before the interruption
+            self.touched_studies.update(studies)
+            print(f"Resuming crawl from {self.last_update}:", *self.checkpoints.items(), sep="\n")
+        else:
+            clear_checkpoints(cursor, CHECKPOINT_CRAWL)
+        self.crawl_id = start_crawl(cursor, CHECKPOINT_CRAWL, resume=bool(self.checkpoints))
+        if self.preload:
+            self.snapshots = {table: LastUpdatedSnapshot.load(self.conn.cursor(), table) for table in Record.FIELDS}
+        tax_trees = get_tax_trees(self.conn.cursor())
+        try:
+            if self.parallel_trees:
+                self._run_parallel(tax_trees, studies)
+            else:
+                self._run_sequential(tax_trees, studies)
+        finally:
+            # also after a failure, the batches written so far are committed
+            self._refresh_summaries()
+        self._add_pubmed_information(self.conn.cursor(), studies)
+        cursor.execute("BEGIN;")
+        set_timestamp(cursor)
+        clear_checkpoints(cursor, CHECKPOINT_CRAWL)
+        finish_crawl(cursor, self.crawl_id)
+        cursor.execute("COMMIT;")
+
+    def _run_sequential(self, tax_trees, studies):
+        for tax_tree, tax_label in tax_trees:
             print(f"{tax_label} ({tax_tree}): ", end="", flush=True)
+            offset, done = self._get_checkpoint(tax_tree)
+            if done:
+                print("done before resuming")
+                continue
             record_states = dict()
-            sub_query = f"%20AND%20tax_tree({tax_tree})%20AND%20last_updated%3E={self.last_update}"
-            query_string = self.base_url + self.query.format(**locals())
-            response = self._get_records(query_string)
-            for i, record in enumerate(response):
-                record.update_db(self.conn.cursor(), tax_tree=tax_tree)
-                study_d = record_states.setdefault(record.study.study_accession, dict())
-                if not study_d:
-                    study_d["state"] = record.record_states["study"]
-                    study_d["samples"] = dict()
-                sample_d = study_d["samples"].setdefault(record.sample.sample_accession, dict())
-                if not sample_d:
-                    sample_d["state"] = record.record_states["sample"]
-                    sample_d["runs"] = dict()
-                run_d = sample_d["runs"].setdefault(record.run.run_accession, record.record_states["run"])
-                studies.add(record.study.study_accession)
+            for records in chunked(self._get_tax_tree_records(tax_tree, offset=offset), self.batch_size):
+                offset += len(records)
+                self._write_records(records, tax_tree, record_states, studies, checkpoint=self._checkpoint(tax_tree, offset))
+            self._checkpoint(tax_tree, offset, done=True)(self.conn.cursor())
+            self._refresh_summaries()
+            self._report_updates(record_states)
+
+    def _run_parallel(self, tax_trees, studies):
+        # workers only fetch and parse, the calling thread is the only one writing to the db
+        records_queue = queue.Queue(maxsize=self.queue_size)
+        stop = threading.Event()
+
+        def crawl(tax_tree):
             try:
-                i = i
-            except:
-                print(f"Nothing to see here")
-            else:
-                self._summarise_updates(record_states)
-        self._add_pubmed_information(self.conn.cursor(), studies)
-        set_timestamp(self.conn.cursor())
+                for records in chunked(self._get_tax_tree_records(tax_tree, offset=offsets[tax_tree]), self.batch_size):
+                    if stop.is_set():
+                        break
+                    records_queue.put((tax_tree, records))
+            except Exception as e:
+                records_queue.put((tax_tree, e))
+            finally:
+                records_queue.put((tax_tree, None))
+
+        labels = dict(tax_trees)
+        crawl_links = CrawlTaxTreeLinks(tax_trees)
+        record_states = {tax_tree: dict() for tax_tree in labels}
+        offsets = dict()
+        for tax_tree in labels:
+            offset, done = self._get_checkpoint(tax_tree)
+            if not done:
+                offsets[tax_tree] = offset
+        # summaries are printed in tax_trees order, each once it and the trees before it are through
+        unreported = [tax_tree for tax_tree, _ in tax_trees]
+        finished = {tax_tree for tax_tree in labels if tax_tree not in offsets}
+
+        def report():
+            while unreported and unreported[0] in finished:
+                tax_tree = unreported.pop(0)
+                print(f"{labels[tax_tree]} ({tax_tree}): ", end="", flush=True)
+                if tax_tree not in offsets:
+                    print("done before resuming")
+                    continue
+                # what this tree saw but a later one wrote first counts here, as in a sequential crawl
+                for later in unreported:
+                    self._take_over_states(record_states[tax_tree], record_states[later])
+                self._report_updates(record_states[tax_tree])
+
+        running = len(offsets)
+        with ThreadPoolExecutor(max_workers=max(1, running)) as pool:
+            for tax_tree in offsets:
+                pool.submit(crawl, tax_tree)
+            try:
+                report()
+                while running:
+                    tax_tree, records = records_queue.get()
+                    if records is None:
+                        running -= 1
+                        self._checkpoint(tax_tree, offsets[tax_tree], done=True)(self.conn.cursor())
+                        finished.add(tax_tree)
+                        report()
+                    elif isinstance(records, Exception):
+                        raise records
+                    else:
+                        offsets[tax_tree] += len(records)
+                        self._write_records(records, tax_tree, record_states[tax_tree], studies, crawl_links=crawl_links,
+                                            checkpoint=self._checkpoint(tax_tree, offsets[tax_tree]))
+            finally:
+                stop.set()
+                # unblock workers still waiting on a full queue
+                while running:
+                    if records_queue.get()[1] is None:
+                        running -= 1
+
+    def _get_checkpoint(self, tax_tree):
+        """ -> (offset, done) to resume the tax tree from """
+        _, offset, done = self.checkpoints.get(tax_tree, (None, 0, False))
+        return offset, done
+
+    def _checkpoint(self, tax_tree, offset, done=False):
+        return partial(set_checkpoint, crawl=CHECKPOINT_CRAWL, tax_tree=tax_tree, watermark=self.last_update,
+                       offset=offset, done=done)
+
+    def _get_tax_tree_records(self, tax_tree, offset=0):
+        limit = self.limit
+        response_format = "tsv" if self.stream else "json"
+        sub_query = f"%20AND%20tax_tree({tax_tree})%20AND%20last_updated%3E={self.last_update}"
+        query_string = self.base_url + self.query.format(**locals())
+        return self._get_records(query_string, offset=offset)
+
+    def _write_records(self, records, tax_tree, record_states, studies, crawl_links=None, checkpoint=None):
+        Record.update_db_many(self.conn.cursor(), records, tax_tree=tax_tree, crawl_links=crawl_links,
+                              seen_runs=self.seen_runs, snapshots=self.snapshots, checkpoint=checkpoint, crawl_id=self.crawl_id,
+                              touched_studies=self.touched_studies)
+        for record in records:
+            self._add_record_states(record_states, record)
+            studies.add(record.study.study_accession)
+
+    def _refresh_summaries(self):
+        if not self.touched_studies:
+            return
+        cursor = self.conn.cursor()
+        cursor.execute("BEGIN;")
+        try:
+            with METRICS.timer("db_seconds", table="study_summary"):
+                refresh_studies(cursor, self.touched_studies)
+        except sqlite3.Error:
+            cursor.execute("ROLLBACK;")
+            raise
+        cursor.execute("COMMIT;")
+        self.touched_studies.clear()
+
+    def _report_updates(self, record_states):
+        if not record_states:
+            print(f"Nothing to see here")
+        else:
+            self._summarise_updates(record_states)
+
+    @staticmethod
+    def _add_record_states(record_states, record):
+        study_d = record_states.setdefault(record.study.study_accession, dict())
+        if not study_d:
+            study_d["state"] = record.record_states["study"]
+            study_d["samples"] = dict()
+        sample_d = study_d["samples"].setdefault(record.sample.sample_accession, dict())
+        if not sample_d:
+            sample_d["state"] = record.record_states["sample"]
+            sample_d["runs"] = dict()
+        sample_d["runs"].setdefault(record.run.run_accession, record.record_states["run"])
+
+    @staticmethod
+    def _iter_states(record_states):
+        """ -> (field, accession, states dict, key) for every state in record_states """
+        for study, study_d in record_states.items():
+            yield "study", study, study_d, "state"
+            for sample, sample_d in study_d["samples"].items():
+                yield "sample", sample, sample_d, "state"
+                for run in sample_d["runs"]:
+                    yield "run", run, sample_d["runs"], run
+
+    @staticmethod
+    def _take_over_states(record_states, later_states):
+        """ moves the new/updated states of later_states to record_states, for the accessions both saw """
+        seen = dict()
+        for field, accession, states, key in EnaPortalScryer._iter_states(record_states):
+            seen.setdefault((field, accession), (states, key))
+        for field, accession, states, key in EnaPortalScryer._iter_states(later_states):
+            if (field, accession) in seen and any(states[key]):
+                own_states, own_key = seen[(field, accession)]
+                if not any(own_states[own_key]):
+                    own_states[own_key] = states[key]
+                states[key] = (False, False)
 
     def _summarise_updates(self, record_states):
         new_studies, updated_studies, new_samples, updated_samples, new_runs, updated_runs = 0, 0, 0, 0, 0, 0
@@ -187,40 +575,70 @@ class EnaPortalScryer:
 
     def _add_pubmed_information(self, cursor, studies):
         def add_pubmed_links(cursor, studies):
-            for study_accession, pubmed_id in PubmedQuery.get_ids(studies):
+            for accessions, links in PubmedQuery.get_links(studies, concurrency=self.concurrency,
+                                                           requests_per_second=self.requests_per_second):
+                cursor.execute("BEGIN;")
                 try:
-                    insert_record(cursor, "study_pubmed", (study_accession, pubmed_id))
-                except:
-                    print("Couldn't update study_pubmed:", study_accession, pubmed_id, file=sys.stderr, flush=True)
+                    insert_pubmed_links(cursor, accessions, links)
+                except sqlite3.Error as e:
+                    cursor.execute("ROLLBACK;")
+                    print(e)
+                    print("Couldn't update study_pubmed:", *accessions, file=sys.stderr, flush=True)
+                else:
+                    cursor.execute("COMMIT;")
 
+        studies = get_stale_pubmed_studies(cursor, studies, self.pubmed_max_age)
         projects = {_id for _id in studies if _id.startswith("P")}
         add_pubmed_links(cursor, studies.difference(projects))
         add_pubmed_links(cursor, projects) # !@£$% SRA!
 
-    def _get_records(self, query_string):
-        offset = self.offset
-        while True:
-            time.sleep(self.sleep_interval)
-            query = query_string.format(offset=offset)
-            try:
-                data = json.loads(requests.get(query).content.decode())
-            except json.decoder.JSONDecodeError:
-                break
-            for record in data:
-                yield Record(**record)
-            if len(data) < self.limit:
-                break
-            offset += self.limit
+    def _get_page(self, query_string, offset):
+        query = query_string.format(offset=offset)
+        if self.stream:
+            return stream_tsv_records(query)
+        content = http_client.get(query).content
+        if not content.strip():
+            # no (more) results
+            return list()
+        try:
+            with METRICS.timer("parse_seconds", format="json"):
+                return json.loads(content.decode())
+        except json.decoder.JSONDecodeError as e:
+            # don't let a garbled page pass as the end of the crawl
+            raise PortalResponseError(f"Couldn't parse response for {query}") from e
+
+    def _get_records(self, query_string, offset=0):
+        pages = PageFetcher(partial(self._get_page, query_string), self.limit, offset=offset,
+                            concurrency=self.concurrency, bucket=self.bucket)
+        for record in pages:
+            yield Record(**record)
 
 
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("db")
+    ap.add_argument("--batch-size", type=int, default=1000)
+    ap.add_argument("--concurrency", type=int, default=1)
+    ap.add_argument("--requests-per-second", type=float)
+    ap.add_argument("--parallel-trees", action="store_true")
+    ap.add_argument("--queue-size", type=int, default=16)
+    ap.add_argument("--stream", action="store_true")
+    ap.add_argument("--no-preload", action="store_true")
+    ap.add_argument("--pubmed-max-age", type=int, default=30)
+    ap.add_argument("--resume", action="store_true", help="continue from the checkpoints of an interrupted crawl")
+    metrics.add_arguments(ap)
     args = ap.parse_args()
 
-    scryer = EnaPortalScryer(args.db)
+    scryer = EnaPortalScryer(args.db, batch_size=args.batch_size,
+                             concurrency=args.concurrency, requests_per_second=args.requests_per_second,
+                             parallel_trees=args.parallel_trees, queue_size=args.queue_size, stream=args.stream,
+                             preload=not args.no_preload, pubmed_max_age=args.pubmed_max_age, resume=args.resume)
     print(*scryer.__dict__.items(), sep="\n")
-    scryer.run()
+    try:
+        scryer.run()
+    finally:
+        # also report on failed crawls, they are the interesting ones
+        metrics.write_report(args, "ena_portal_scryer")
 
 if __name__ == "__main__":
     main()
@@ -8,9 +8,18 @@ import sqlite3
 import json
 
 from bs4 import BeautifulSoup
-import requests
 
-from db_helpers import check_record_exists, insert_record, update_record
+import http_client
+import metrics
+from bulk_load import BulkLoader, get_entity_row, get_reject_reason, reject_record, restore_indexes
+from changes import finish_crawl, log_changes, start_crawl
+from db_helpers import check_record_exists, insert_record, update_record, insert_pubmed_links
+from db_helpers import get_checkpoints, set_checkpoint, clear_checkpoints, get_stale_pubmed_studies, get_records
+from metrics import METRICS
+from migrations import open_db
+from portal_stream import stream_tsv_records
+from pubmed import PubmedQuery
+from study_summary import refresh_studies
 
 DEBUG = False
 
@@ -24,7 +33,9 @@ BASE_QUERY = "instrument_platform=%22ILLUMINA%22" \
              "OR%20(library_strategy=%22RNA-Seq%22%20AND%20library_source=%22METATRANSCRIPTOMIC%22))" \
              "{sub_query}&limit={limit}&offset={{offset}}"
 
-MAIN_QUERY = f"search?result=read_run&includeMetagenomes=1&format=json&fields={','.join(FIELDS)}&query={BASE_QUERY}"
+CHECKPOINT_CRAWL = "filldb"
+
+MAIN_QUERY = f"search?result=read_run&includeMetagenomes=1&format={{response_format}}&fields={','.join(FIELDS)}&query={BASE_QUERY}"
 
 TAX_TREES = {
     256318: "metagenomics",
@@ -35,81 +46,169 @@ TAX_TREES = {
 
 
 class EnaPortalScryer:
-    def __init__(self, base_url, query, sub_query="", limit=1000):
+    def __init__(self, base_url, query, sub_query="", limit=1000, stream=False, offset=0):
+        response_format = "tsv" if stream else "json"
         self.query_string = base_url + query.format(**locals())
-        self.offset = 0
+        self.offset = offset
         self.limit = limit
-    def get_records(self):
+        self.stream = stream
+    def get_records(self, page_done=None):
+        """ page_done(offset) is called once all records of a full page have been consumed,
+        with the offset of the next page. """
         while True:
-            time.sleep(0.1)
             query = self.query_string.format(offset=self.offset)
             #print(query)
-            data = json.loads(requests.get(query).content.decode())
+            if self.stream:
+                data = stream_tsv_records(query)
+            else:
+                content = http_client.get(query).content.decode()
+                with METRICS.timer("parse_seconds", format="json"):
+                    data = json.loads(content or "[]")
+            n_records = 0
             for record in data:
+                n_records += 1
                 yield record
-            if len(data) < self.limit:
+            if n_records < self.limit:
                 break
             self.offset += self.limit
-
-
-
-
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("db")
-    args = ap.parse_args()
-
-
-    studies = set()
+            if page_done is not None:
+                page_done(self.offset)
+
+
+
+
+def backfill(args):
+    conn = open_db(args.db)
+    # indexes left behind by an interrupted bulk load
+    restore_indexes(conn)
+    with conn:
+        cursor = conn.cursor()
+        checkpoints = get_checkpoints(cursor, CHECKPOINT_CRAWL) if args.resume else dict()
+        studies = set()
+        if checkpoints:
+            # the studies written before the interruption still need their pubmed links, unless a crawl checked them since
+            cursor.execute("SELECT study_accession FROM study;")
+            studies.update(get_stale_pubmed_studies(cursor, [row[0] for row in cursor.fetchall()], args.pubmed_max_age))
+        else:
+            clear_checkpoints(cursor, CHECKPOINT_CRAWL)
+        crawl_id = start_crawl(cursor, CHECKPOINT_CRAWL, resume=bool(checkpoints))
+    conn.close()
+
+    if args.bulk:
+        bulk_backfill(args, checkpoints, studies, crawl_id)
+    else:
+        record_backfill(args, checkpoints, studies, crawl_id)
+
+    conn = open_db(args.db)
+    with conn:
+        clear_checkpoints(conn.cursor(), CHECKPOINT_CRAWL)
+        finish_crawl(conn.cursor(), crawl_id)
+    conn.close()
+
+def bulk_backfill(args, checkpoints, studies, crawl_id=None):
+    conn = open_db(args.db)
+    cursor = conn.cursor()
+    with BulkLoader(conn, crawl=CHECKPOINT_CRAWL, chunk_size=args.chunk_size, crawl_id=crawl_id) as loader:
+        for tax_tree in TAX_TREES:
+            _, offset, done = checkpoints.get(tax_tree, (None, 0, False))
+            if done:
+                print(f"tax_tree({tax_tree}) done before resuming")
+                continue
+            sub_query = f"%20AND%20tax_tree({tax_tree})"
+            scryer = EnaPortalScryer(BASE_API_URL, MAIN_QUERY, sub_query=sub_query, limit=100000, stream=args.stream, offset=offset)
+
+            def page_done(offset):
+                loader.flush()
+                set_checkpoint(cursor, CHECKPOINT_CRAWL, tax_tree, None, offset)
+                conn.commit()
+
+            for record in scryer.get_records(page_done=page_done):
+                studies.add(record.get("study_accession"))
+                loader.add(record)
+            loader.flush()
+            set_checkpoint(cursor, CHECKPOINT_CRAWL, tax_tree, None, scryer.offset, done=True)
+            conn.commit()
+            print(f"tax_tree({tax_tree}): {loader.n_loaded} records loaded, {loader.n_rejected} rejected so far")
+
+    studies.discard(None)
+    projects = {_id for _id in studies if _id.startswith("P")}
+    studies.difference_update(projects)
+    with conn:
+        add_pubmed_information(cursor, studies)
+        add_pubmed_information(cursor, projects) # !@£$% SRA!
+    conn.close()
+
+def record_backfill(args, checkpoints, studies, crawl_id=None):
+    n_written, n_rejected = 0, 0
     for tax_tree in TAX_TREES:
+        _, offset, done = checkpoints.get(tax_tree, (None, 0, False))
+        if done:
+            print(f"tax_tree({tax_tree}) done before resuming")
+            continue
         #sub_query="%20AND%20tax_tree(256318)%20AND%20last_updated%3E=2021-02-01"
         sub_query = f"%20AND%20tax_tree({tax_tree})"
-        scryer = EnaPortalScryer(BASE_API_URL, MAIN_QUERY, sub_query=sub_query, limit=100000)
+        scryer = EnaPortalScryer(BASE_API_URL, MAIN_QUERY, sub_query=sub_query, limit=100000, stream=args.stream, offset=offset)
 
-        conn = sqlite3.connect(args.db)
+        conn = open_db(args.db)
         with conn:
             cursor = conn.cursor()
 
+            # studies to refresh, and the samples runs were moved away from (their studies are looked up once per page)
+            page_studies, old_samples = set(), set()
+
+            def refresh_page_studies():
+                old_samples.discard(None)
+                if old_samples:
+                    columns, samples = get_records(cursor, "sample", old_samples)
+                    page_studies.update(row[columns.index("study_accession")] for row in samples.values())
+                page_studies.discard(None)
+                refresh_studies(cursor, page_studies)
+                page_studies.clear()
+                old_samples.clear()
+
+            def page_done(offset):
+                # commit every page together with the offset to resume from and the refreshed summaries
+                refresh_page_studies()
+                set_checkpoint(cursor, CHECKPOINT_CRAWL, tax_tree, None, offset)
+                conn.commit()
+
             if True:
-	            for record in scryer.get_records():
+	            for record in scryer.get_records(page_done=page_done):
 	                #print(record)
 	                studies.add(record["study_accession"])
-	
-	                study = (record["study_accession"], record["study_title"], 
-	                         record["first_public"], record["last_updated"], 1)
-	                sample = (record["sample_accession"], record["host"],
-	                          record["host_body_site"], record["host_tax_id"],
-	                          record["environment_biome"])
-	                run = (record["run_accession"], record["experiment_title"],
-	                       record["description"], record["instrument_model"], record["instrument_platform"],
-	                       record["library_source"], record["library_layout"], record["library_strategy"],
-	                       record["nominal_length"], record["read_count"])
-	
+	                page_studies.add(record["study_accession"])
+
+	                reason = get_reject_reason(cursor, record)
+	                if reason is not None:
+	                    reject_record(cursor, record, reason, crawl=CHECKPOINT_CRAWL)
+	                    n_rejected += 1
+	                    continue
+	                # a record is written completely or not at all
+	                if not conn.in_transaction:
+	                    cursor.execute("BEGIN;")
+	                cursor.execute("SAVEPOINT record;")
 	                try:
-	                    process_updates(cursor, "study", study)     
-	                except:
-	                    print("Couldn't update study:", study, file=sys.stderr, flush=True)
-	                   
-	                try:
-	                    process_updates(cursor, "sample", sample)
-	                except:
-	                    print("Couldn't update sample:", sample, file=sys.stderr, flush=True)
-	
-	                try:
-	                    process_updates(cursor, "run", run)
-	                except:
-	                    print("Couldn't update run:", run, file=sys.stderr, flush=True)
-	
-	                try:
-	                    insert_record(cursor, "study_sample", (record["study_accession"], record["sample_accession"]))
-	                except:
-	                    print("Couldn't update study_sample:", study[0], sample[0], file=sys.stderr, flush=True)
-	                    pass
-	                try:
-	                    insert_record(cursor, "sample_run", (record["sample_accession"], record["run_accession"]))
-	                except:
-	                    print("Couldn't update sample_run:", sample, run, file=sys.stderr, flush=True)
-	                    pass
+	                    previous = dict()
+	                    for table in ("study", "sample", "run"):
+	                        previous[table] = process_updates(cursor, table, get_entity_row(record, table), crawl_id=crawl_id)
+	                    cursor.execute("INSERT OR IGNORE INTO study_sample VALUES (?, ?);",
+	                                   (record["study_accession"], record["sample_accession"]))
+	                    cursor.execute("INSERT OR IGNORE INTO sample_run VALUES (?, ?);",
+	                                   (record["sample_accession"], record["run_accession"]))
+	                except sqlite3.Error as e:
+	                    cursor.execute("ROLLBACK TO record;")
+	                    reject_record(cursor, record, str(e), crawl=CHECKPOINT_CRAWL)
+	                    n_rejected += 1
+	                else:
+	                    n_written += 1
+	                    # a sample or run moved to another study also changes the study it leaves
+	                    page_studies.add(previous["sample"].get("study_accession"))
+	                    old_samples.add(previous["run"].get("sample_accession"))
+	                cursor.execute("RELEASE record;")
+	            refresh_page_studies()
+	            set_checkpoint(cursor, CHECKPOINT_CRAWL, tax_tree, None, scryer.offset, done=True)
+	            conn.commit()
+	            print(f"tax_tree({tax_tree}): {n_written} records written, {n_rejected} rejected so far")
 
             # studies = set(line.strip() for line in open("studies.txt"))
             projects = {_id for _id in studies if _id.startswith("P")}
@@ -117,50 +216,56 @@ def main():
             add_pubmed_information(cursor, studies)
             add_pubmed_information(cursor, projects) # !@£$% SRA!
 
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("db")
+    ap.add_argument("--stream", action="store_true")
+    ap.add_argument("--requests-per-second", type=float, default=10)
+    ap.add_argument("--resume", action="store_true", help="continue from the checkpoints of an interrupted backfill")
+    ap.add_argument("--bulk", action="store_true", help="bulk-load mode for initial fills")
+    ap.add_argument("--chunk-size", type=int, default=50000, help="records per staging merge in bulk-load mode")
+    ap.add_argument("--pubmed-max-age", type=int, default=30,
+                    help="with --resume, days after which the pubmed links of the studies already written are checked again")
+    metrics.add_arguments(ap)
+    args = ap.parse_args()
+
+    http_client.set_rate_limit(urllib.parse.urlsplit(BASE_API_URL).netloc, args.requests_per_second)
+
+    try:
+        backfill(args)
+    finally:
+        metrics.write_report(args, "ena_portal_scryer_filldb")
+
 def add_pubmed_information(cursor, studies):
-    study_queries = [("accessions", study_id) for study_id in studies]
-    xml = requests.post("https://www.ebi.ac.uk/ena/browser/api/xml", data=study_queries).content.decode()
-    xml = xml.replace("\n", "")
-    xml = re.sub(">\s+<", "><", xml)
-    soup = BeautifulSoup(xml, "lxml-xml")
- 
-    if soup:
-        studies = soup.find_all("PROJECT")
-        if studies:
-            for study in studies:
-                study_accession = study.PRIMARY_ID.text
-                project_links = study.find("PROJECT_LINKS")
-                if project_links:
-                    xref_links = project_links.find_all("XREF_LINK")
-                    if xref_links:
-                        for xref_link in xref_links:
-                            try:
-                                db, _id = xref_link.DB.text, xref_link.ID.text
-                            except:
-                                continue
-                            if db == "PUBMED":
-                                #print(xref_link)
-                                #print("******************")
-                                try:
-                                    insert_record(cursor, "study_pubmed", (study_accession, _id))
-                                except:
-                                    print("Couldn't update study_pubmed:", study_accession, _id, file=sys.stderr, flush=True)
+    for accessions, links in PubmedQuery.get_links(studies):
+        try:
+            insert_pubmed_links(cursor, accessions, links)
+        except:
+            print("Couldn't update study_pubmed:", *accessions, file=sys.stderr, flush=True)
 
 
 def exists_in_db(cursor, table, record):
     updates, existing_record = list(), list(check_record_exists(cursor, table, record[0]))
     if existing_record:
+        # the portal sends numbers as strings, the INTEGER columns return them as int
         updates = [(header, new_col) 
                    for (header, cur_col), new_col in zip(existing_record, record)
-                   if new_col != cur_col]
+                   if new_col != cur_col and str(new_col) != str(cur_col)]
     return existing_record, updates
-def process_updates(cursor, table, record):
-    existing_record, updates = exists_in_db(cursor, table, record)
-    has_updates = not existing_record or updates
-    if not existing_record:
-        insert_record(cursor, table, record)
-    elif updates:
-        update_record(cursor, table, record[0], updates)
+def process_updates(cursor, table, record, crawl_id=None):
+    """ -> the db row before the update, as a dict (empty for new records) """
+    with METRICS.timer("db_seconds", table=table):
+        existing_record, updates = exists_in_db(cursor, table, record)
+        has_updates = not existing_record or updates
+        if not existing_record:
+            insert_record(cursor, table, record)
+        elif updates:
+            update_record(cursor, table, record[0], updates)
+        if crawl_id is not None and has_updates:
+            change = ("update", [col for col, _ in updates]) if existing_record else ("insert", None)
+            log_changes(cursor, crawl_id, table, [(record[0],) + change])
+    METRICS.count_records(table, int(not existing_record), int(bool(existing_record and updates)), int(not has_updates))
+    return dict(existing_record)
 
 
 #def check_link_exists(cursor, table, field1, field2, id1, id2):
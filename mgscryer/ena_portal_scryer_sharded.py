@@ -0,0 +1,220 @@
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import time
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+
+import http_client
+import metrics
+from bulk_load import STAGING_COLUMNS, BulkLoader, restore_indexes
+from changes import finish_crawl, start_crawl
+from db_helpers import get_stale_pubmed_studies
+from ena_portal_scryer_filldb import BASE_API_URL, MAIN_QUERY, TAX_TREES, EnaPortalScryer, add_pubmed_information
+from metrics import METRICS
+from migrations import open_db
+
+CRAWL = "sharded"
+FIRST_WINDOW = "2010-01-01"
+WINDOW_FIELDS = ("first_public", "last_updated")
+
+
+class Shard:
+    """ One tax tree query restricted to start <= window_field < end (either end may be open),
+    crawled into its own sqlite file. """
+    def __init__(self, shard_dir, tax_tree, window_field, start, end):
+        self.tax_tree = tax_tree
+        self.window_field = window_field
+        self.start = start
+        self.end = end
+        self.path = os.path.join(shard_dir, f"{tax_tree}_{window_field}_{start or 'min'}_{end or 'max'}.sqlite")
+    def __str__(self):
+        return f"tax_tree({tax_tree_str(self.tax_tree)}) {self.start or '...'} <= {self.window_field} < {self.end or '...'}"
+    @property
+    def sub_query(self):
+        sub_query = f"%20AND%20tax_tree({self.tax_tree})"
+        if self.start:
+            sub_query += f"%20AND%20{self.window_field}%3E={self.start}"
+        if self.end and not self.start:
+            # records without a date match no window bounds, the first window takes them
+            sub_query += f"%20AND%20({self.window_field}%3C{self.end}%20OR%20{self.window_field}=%22%22)"
+        elif self.end:
+            sub_query += f"%20AND%20{self.window_field}%3C{self.end}"
+        return sub_query
+    def get_state(self):
+        """ None (not crawled or not completely), "crawled" or "merged" """
+        if not os.path.exists(self.path):
+            return None
+        conn = sqlite3.connect(self.path)
+        try:
+            done, merged = conn.execute("SELECT done, merged FROM shard_info;").fetchone()
+        except (sqlite3.Error, TypeError):
+            return None
+        finally:
+            conn.close()
+        return "merged" if merged else ("crawled" if done else None)
+
+def tax_tree_str(tax_tree):
+    return f"{tax_tree}:{TAX_TREES[tax_tree]}"
+
+
+def get_windows(first=FIRST_WINDOW, months=12, last=None):
+    """ [(None, first), (first, first + months), ..., (x, None)] - the first and last window are open """
+    last = last or date.today().isoformat()
+    year, month = int(first[:4]), int(first[5:7])
+    bounds = list()
+    while f"{year:04d}-{month:02d}-01" <= last:
+        bounds.append(f"{year:04d}-{month:02d}-01")
+        year, month = year + (month - 1 + months) // 12, (month - 1 + months) % 12 + 1
+    return list(zip([None] + bounds, bounds + [None]))
+
+def get_shards(shard_dir, window_field="first_public", first=FIRST_WINDOW, months=12):
+    return [Shard(shard_dir, tax_tree, window_field, start, end)
+            for tax_tree in TAX_TREES
+            for start, end in get_windows(first=first, months=months)]
+
+
+def crawl_shard(shard, base_url, stream=False, limit=100000, chunk_size=50000, requests_per_second=None):
+    """ runs in a worker process: writes the records of the shard to its staging_record table,
+    shard_info.done is only set once the window is through.
+    Returns the metrics the worker recorded along with it, for the parent to merge. """
+    if requests_per_second:
+        http_client.set_rate_limit(urllib.parse.urlsplit(base_url).netloc, requests_per_second)
+    start_time = time.perf_counter()
+    if os.path.exists(shard.path):
+        os.remove(shard.path)
+    conn = sqlite3.connect(shard.path)
+    # a shard that is not done is crawled again, it doesn't need to survive a crash
+    conn.execute("PRAGMA synchronous = OFF;")
+    conn.execute("CREATE TABLE shard_info (tax_tree INTEGER, window_field TEXT, start TEXT, end TEXT, done INTEGER, merged INTEGER);")
+    conn.execute("CREATE TABLE staging_record ({columns});".format(columns=", ".join(STAGING_COLUMNS)))
+    conn.execute("INSERT INTO shard_info VALUES (?, ?, ?, ?, 0, 0);", (shard.tax_tree, shard.window_field, shard.start, shard.end))
+    conn.commit()
+
+    insert = "INSERT INTO staging_record VALUES ({dummy});".format(dummy=",".join("?" for _ in STAGING_COLUMNS))
+    scryer = EnaPortalScryer(base_url, MAIN_QUERY, sub_query=shard.sub_query, limit=limit, stream=stream)
+    rows, n_records = list(), 0
+    for record in scryer.get_records():
+        rows.append(tuple(record.get(column) for column in STAGING_COLUMNS))
+        if len(rows) == chunk_size:
+            conn.executemany(insert, rows)
+            n_records, rows = n_records + len(rows), list()
+    conn.executemany(insert, rows)
+    n_records += len(rows)
+    conn.execute("UPDATE shard_info SET done = 1;")
+    conn.commit()
+    conn.close()
+    return n_records, time.perf_counter() - start_time, METRICS.drain()
+
+def merge_shard(loader, shard):
+    """ folds a crawled shard into the main db and empties it, returns the studies it contains """
+    conn, cursor = loader.conn, loader.cursor
+    # ATTACH is not allowed inside a transaction
+    conn.commit()
+    cursor.execute("ATTACH DATABASE ? AS shard;", (shard.path,))
+    try:
+        with METRICS.timer("db_seconds", table="shard_merge"):
+            loader.merge("shard.staging_record")
+        cursor.execute("SELECT DISTINCT study_accession FROM shard.staging_record;")
+        studies = {row[0] for row in cursor.fetchall()}
+        # merging a shard twice is harmless, and so is merging one crawled before an interruption:
+        # the merge only rewrites rows with newer records
+        cursor.execute("DELETE FROM shard.staging_record;")
+        cursor.execute("UPDATE shard.shard_info SET merged = 1;")
+        conn.commit()
+    finally:
+        cursor.execute("DETACH DATABASE shard;")
+    return studies
+
+def sharded_backfill(args):
+    shard_dir = args.shard_dir or args.db + ".shards"
+    os.makedirs(shard_dir, exist_ok=True)
+    shards = get_shards(shard_dir, window_field=args.window_field, first=args.first_window, months=args.window_months)
+    studies = set()
+
+    conn = open_db(args.db)
+    # indexes left behind by an interrupted bulk load
+    restore_indexes(conn)
+    with conn:
+        crawl_id = start_crawl(conn.cursor(), CRAWL, resume=args.resume)
+    if args.resume:
+        # the studies merged before the interruption still need their pubmed links, unless a crawl checked them since
+        merged = [row[0] for row in conn.execute("SELECT study_accession FROM study;")]
+        studies.update(get_stale_pubmed_studies(conn.cursor(), merged, args.pubmed_max_age))
+    else:
+        for shard in shards:
+            if os.path.exists(shard.path):
+                os.remove(shard.path)
+    states = {shard: shard.get_state() for shard in shards}
+    if args.resume:
+        print(f"{sum(state == 'merged' for state in states.values())} shards merged and "
+              f"{sum(state == 'crawled' for state in states.values())} crawled before resuming")
+
+    with BulkLoader(conn, crawl=CRAWL, chunk_size=args.chunk_size, crawl_id=crawl_id) as loader:
+        for shard in shards:
+            if states[shard] == "crawled":
+                studies.update(merge_shard(loader, shard))
+        # each process gets its share of the request rate
+        requests_per_second = args.requests_per_second / args.processes if args.requests_per_second else None
+        # spawned, not forked: the workers must not share the http sessions and db connections of this process
+        executor = ProcessPoolExecutor(max_workers=args.processes, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            futures = {executor.submit(crawl_shard, shard, BASE_API_URL, stream=args.stream, chunk_size=args.chunk_size,
+                                       requests_per_second=requests_per_second): shard
+                       for shard in shards if states[shard] is None}
+            # shards are merged as they come in, the merges overlap with the crawls still running
+            for future in as_completed(futures):
+                shard = futures[future]
+                n_records, seconds, shard_metrics = future.result()
+                METRICS.merge(shard_metrics)
+                METRICS.observe("shard_seconds", seconds)
+                studies.update(merge_shard(loader, shard))
+                print(f"{shard}: {n_records} records in {seconds:.1f}s")
+        finally:
+            # don't start any more shards after a failure, --resume picks them up
+            executor.shutdown(cancel_futures=True)
+        print(f"{loader.n_loaded} records loaded, {loader.n_rejected} rejected")
+
+    studies.discard(None)
+    projects = {_id for _id in studies if _id.startswith("P")}
+    studies.difference_update(projects)
+    with conn:
+        cursor = conn.cursor()
+        add_pubmed_information(cursor, studies)
+        add_pubmed_information(cursor, projects) # !@£$% SRA!
+        finish_crawl(cursor, crawl_id)
+    conn.close()
+
+    for shard in shards:
+        os.remove(shard.path)
+    if not os.listdir(shard_dir):
+        os.rmdir(shard_dir)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="backfill with one process per tax tree and date window")
+    ap.add_argument("db")
+    ap.add_argument("--processes", type=int, default=os.cpu_count())
+    ap.add_argument("--window-field", choices=WINDOW_FIELDS, default="first_public")
+    ap.add_argument("--window-months", type=int, default=12)
+    ap.add_argument("--first-window", default=FIRST_WINDOW, help="everything before this date goes into one window")
+    ap.add_argument("--shard-dir", help="where to keep the shard dbs until they are merged (default: <db>.shards)")
+    ap.add_argument("--stream", action="store_true")
+    ap.add_argument("--requests-per-second", type=float, default=10, help="in total, split between the processes")
+    ap.add_argument("--chunk-size", type=int, default=50000)
+    ap.add_argument("--resume", action="store_true", help="only crawl and merge the shards not merged before an interruption")
+    ap.add_argument("--pubmed-max-age", type=int, default=30,
+                    help="with --resume, days after which the pubmed links of the studies already merged are checked again")
+    metrics.add_arguments(ap)
+    args = ap.parse_args()
+
+    try:
+        sharded_backfill(args)
+    finally:
+        metrics.write_report(args, "ena_portal_scryer_sharded")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,10 +5,15 @@ from datetime import datetime
 import urllib.parse
 import argparse
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 
-from bs4 import BeautifulSoup
-import urllib3
-import requests
+from lxml import etree
+
+import http_client
+import metrics
+from accessions import AccessionRanges
+from db_helpers import chunked
+from metrics import METRICS
 
 BASE_API_URL = "https://www.ebi.ac.uk/ena/browser/api/xml/"
 PROJECT_QUERY = "search?query=host_tax_id=9606%20AND%20(instrument_platform=%22ILLUMINA%22%20AND%20(%20instrument_model!=%22Illumina%20Genome%20Analyzer%22%20AND%20instrument_model!=%22Illumina%20Genome%20Analyzer%20II%22%20AND%20instrument_model!=%22Illumina%20Genome%20Analyzer%20IIx%22%20)%20AND%20(%20(%20library_strategy=%22WGS%22%20AND%20library_source=%22METAGENOMIC%22%20)%20OR%20(%20library_strategy=%22RNA-Seq%22%20AND%20library_source=%22METATRANSCRIPTOMIC%22%20)%20))&result=read_study&sortFields=accession" #last_updated" <- this doesn't work >:(
@@ -20,37 +25,32 @@ class EntityParseError(Exception):
 
 class Entity:
     @staticmethod
+    def get_text(xml):
+        # what bs4 used to return after rest_query had stripped newlines and whitespace between tags
+        text = "".join(xml.itertext()).replace("\n", "")
+        return text if text.strip() else ""
+    @staticmethod
     def get_tag_value_pairs(xml):
-        for child in xml.children:
-            tag = child.find("TAG")
-            if tag:
-                tag = tag.text.lower()
-            value = child.find("VALUE")
-            if value:
-                value = value.text.lower()
+        for child in xml:
+            tag = child.find(".//TAG")
+            if tag is not None:
+                tag = Entity.get_text(tag).lower()
+            value = child.find(".//VALUE")
+            if value is not None:
+                value = Entity.get_text(value).lower()
             if tag and value:
                 yield tag, value
     @staticmethod
     def parse_xlink_ids(ids):
-        individual_ids = list()
-        ids = ids.split(",")
-        for item in ids:
-            item = item.split("-")
-            if len(item) == 1:
-                individual_ids.extend(item)
-            else:
-                start, end = item
-                prefix = "".join(map(lambda c:(c if c.isalpha() else " "), start)).strip().split(" ")[0]
-                suffix = "{{id:0{n}d}}".format(n=len(start) - len(prefix))
-                start, end = map(lambda x:int(x[len(prefix):]), (start, end))
-                individual_ids.extend("{prefix}{suffix}".format(prefix=prefix, suffix=suffix.format(id=_id)) for _id in range(start, end + 1))
-        return individual_ids
+        return AccessionRanges(ids)
     @staticmethod
     def parse_xlinks(xml):
         d = dict()
-        for link in xml.children:
-            xlink = link.find("XREF_LINK")
-            db, val = map(lambda x:x.text, xlink.children)
+        for link in xml:
+            xlink = link.find(".//XREF_LINK")
+            if xlink is None:
+                continue
+            db, val = map(Entity.get_text, xlink)
             db = db.lower()
             if db == "pubmed":
                 d[db] = val.split(",")
@@ -60,16 +60,16 @@ class Entity:
     @staticmethod
     def parse_common_fields(xml, caller=None):
         attribs = dict()
-        identifiers = xml.find("IDENTIFIERS")
+        identifiers = xml.find(".//IDENTIFIERS")
         for field in ("primary_id", "secondary_id", "name", "title", "description"):
             try:
-                attribs[field] = identifiers.find(field.upper()).text
+                attribs[field] = Entity.get_text(identifiers.find(".//" + field.upper()))
             except:
                 attribs[field] = None
 
         if caller:
-            caller_attribs = xml.find("{cls}_ATTRIBUTES".format(cls=caller.__name__.upper()))
-            if caller_attribs:
+            caller_attribs = xml.find(".//{cls}_ATTRIBUTES".format(cls=caller.__name__.upper()))
+            if caller_attribs is not None:
                 caller_attribs = dict(Entity.get_tag_value_pairs(caller_attribs))
 
                 attribs["ena_first_public"] = caller_attribs.get("ena-first-public")
@@ -82,18 +82,12 @@ class Entity:
         entities = dict()
         ids = self.xlinks.get("ena-{}".format(entity_name.lower()))
         if ids:
-            for idrange in ids.split(","):
-                xml = rest_query(idrange)
+            for idrange in Entity.parse_xlink_ids(ids).query_strings():
                 if DEBUG:
                     print(entity_name)
-                    print(xml)
-                for entity_xml in xml.find_all(entity_name.upper()):
-                    try:
-                        entity_obj = entity_type.from_xml(entity_xml)
-                        if DEBUG:
-                            entity_obj.show()
-                    except:
-                        raise EntityParseError("{entity_type} could not be parsed.\n{xml}".format(entity_type=entity_name.lower(), xml=entity_xml))
+                for entity_obj in query_entities(idrange, entity_type):
+                    if DEBUG:
+                        entity_obj.show()
                     entities[entity_obj.primary_id] = entity_obj
 
         return entities
@@ -109,42 +103,21 @@ class Entity:
     def as_tuple(self):
         return tuple()
     def exists_in_db(self, cursor):
-        requires_update = False
         exists = list(check_record_exists(cursor, self.__class__.__name__.lower(), self.primary_id))
-        if exists and not isinstance(self, Experiment):
+        return exists, bool(exists) and self.is_newer_than([value for _, value in exists])
+    def is_newer_than(self, current_row):
+        if isinstance(self, Experiment):
             # we assume that experiments are never updated? they don't have a timestamp
-            new_ts, cur_ts = map(datetime.fromisoformat,
-                (self.ena_last_update, exists[-2 if isinstance(self, Project) else -1][1]))
-            requires_update = new_ts > cur_ts
-        return exists, requires_update
+            return False
+        new_ts, cur_ts = map(datetime.fromisoformat,
+            (self.ena_last_update, current_row[-2 if isinstance(self, Project) else -1]))
+        return new_ts > cur_ts
     def process_updates(self, cursor):
-        has_updates = False
-        table = self.__class__.__name__.lower()
-        existing_record, requires_update = self.exists_in_db(cursor)
-        if not existing_record:
-            has_updates = True
-            self.insert_into_db(cursor)
-        elif requires_update:
-            has_updates = True
-            self.update_db_record(cursor, existing_record)
-        else:
-            if DEBUG:
-                print("existing record", table, self.primary_id)
-        for child_id, child in self.children.items():
-            has_updates |= child.process_updates(cursor)
-            update_links(cursor, self, child)
-        return has_updates
-    def insert_into_db(self, cursor):
-        table = self.__class__.__name__.lower()
-        if DEBUG:
-            print("new {table} record: {id}".format(table=table, id=self.primary_id))
-        insert_record(cursor, table, self.as_tuple())
-    def update_db_record(self, cursor, current_record):
-        updates = [(header, new_col)
-                   for (header, cur_col), new_col in zip(current_record, self.as_tuple())
-                   if new_col != cur_col]
-        update_record(cursor, self.__class__.__name__.lower(), self.primary_id, updates)
-        print("record updated:", self.__class__.__name__.lower(), self.primary_id, updates)
+        return TreeSync(cursor).sync(self)
+    def get_changes(self, columns, current_row):
+        return [(header, new_col)
+                for header, cur_col, new_col in zip(columns, current_row, self.as_tuple())
+                if new_col != cur_col]
 
 class Run(Entity):
     def __init__(self, **args):
@@ -153,12 +126,12 @@ class Run(Entity):
     def from_xml(cls, xml):
         attribs = Entity.parse_common_fields(xml, caller=cls)
 
-        run_attribs = dict(Entity.get_tag_value_pairs(xml.find("RUN_ATTRIBUTES")))
+        run_attribs = dict(Entity.get_tag_value_pairs(xml.find(".//RUN_ATTRIBUTES")))
         attribs["read_count"] = run_attribs.get("ena-spot-count")
         attribs["ena_first_public"] = run_attribs.get("ena-first-public")
         attribs["ena_last_update"] = run_attribs.get("ena-last-update")
 
-        attribs["xlinks"] = Entity.parse_xlinks(xml.find("RUN_LINKS"))
+        attribs["xlinks"] = Entity.parse_xlinks(xml.find(".//RUN_LINKS"))
 
         return Run(**attribs)
     def as_tuple(self):
@@ -171,25 +144,25 @@ class Experiment(Entity):
     def from_xml(cls, xml):
         attribs = Entity.parse_common_fields(xml, caller=cls)
 
-        design = xml.find("DESIGN")
-        if design:
-            lib_desc = design.find("LIBRARY_DESCRIPTOR")
-            if lib_desc:
-                for child in lib_desc.children:
-                    tag = child.name.lower()
+        design = xml.find(".//DESIGN")
+        if design is not None:
+            lib_desc = design.find(".//LIBRARY_DESCRIPTOR")
+            if lib_desc is not None:
+                for child in lib_desc:
+                    tag = child.tag.lower()
                     if tag in ("library_strategy", "library_source", "library_selection"):
-                        attribs[tag] = child.text
+                        attribs[tag] = Entity.get_text(child)
                     elif tag == "library_layout":
-                        attribs["library_layout"] = next(child.children).name
+                        attribs["library_layout"] = next(iter(child)).tag
             try:
-                attribs["spot_length"] = design.find("SPOT_LENGTH").text
+                attribs["spot_length"] = Entity.get_text(design.find(".//SPOT_LENGTH"))
             except:
                 attribs["spot_length"] = None
 
-        platform = xml.find("PLATFORM")
-        attribs["instrument"] = platform.find("INSTRUMENT_MODEL").text
+        platform = xml.find(".//PLATFORM")
+        attribs["instrument"] = Entity.get_text(platform.find(".//INSTRUMENT_MODEL"))
 
-        attribs["xlinks"] = Entity.parse_xlinks(xml.find("EXPERIMENT_LINKS"))
+        attribs["xlinks"] = Entity.parse_xlinks(xml.find(".//EXPERIMENT_LINKS"))
 
         return Experiment(**attribs)
 
@@ -205,18 +178,18 @@ class Sample(Entity):
     def from_xml(cls, xml):
         attribs = Entity.parse_common_fields(xml, caller=cls)
 
-        biosample = xml.find("IDENTIFIERS").find(namespace="BioSample")
-        attribs["biosample"] = biosample.text if biosample else None
-        tax_attribs = xml.find("SAMPLE_NAME")
+        biosample = xml.find(".//IDENTIFIERS").find(".//*[@namespace='BioSample']")
+        attribs["biosample"] = Entity.get_text(biosample) if biosample is not None else None
+        tax_attribs = xml.find(".//SAMPLE_NAME")
         try:
-            taxon_id, scientific_name = map(lambda x:x.text, tax_attribs.children)
+            taxon_id, scientific_name = map(Entity.get_text, tax_attribs)
         except:
             taxon_id, scientific_name = None, None
         attribs.update({"taxon_id": taxon_id, "scientific_name": scientific_name})
 
-        attribs["xlinks"] = Entity.parse_xlinks(xml.find("SAMPLE_LINKS"))
+        attribs["xlinks"] = Entity.parse_xlinks(xml.find(".//SAMPLE_LINKS"))
 
-        sample_attribs = dict(Entity.get_tag_value_pairs(xml.find("SAMPLE_ATTRIBUTES")))
+        sample_attribs = dict(Entity.get_tag_value_pairs(xml.find(".//SAMPLE_ATTRIBUTES")))
         attribs["ena_first_public"] = sample_attribs.get("ena-first-public")
         attribs["ena_last_update"] = sample_attribs.get("ena-last-update")
         return Sample(**attribs)
@@ -226,13 +199,24 @@ class Sample(Entity):
                 self.ena_first_public, self.ena_last_update)
 
 class Project(Entity):
-    def __init__(self, **args):
+    def __init__(self, fetch_children=True, **args):
         super().__init__(**args)
-        self._process_children()
-    def _process_children(self):
-        self.children = samples = self.get_linked_entities(Sample)
-        experiments = self.get_linked_entities(Experiment)
-        runs = self.get_linked_entities(Run)
+        if fetch_children:
+            self._process_children()
+    def _process_children(self, samples=None, experiments=None, runs=None):
+        """ Links samples, experiments and runs into this project's tree.
+        The entities can be passed in as {primary_id: entity} dicts shared by many projects,
+        otherwise they are queried for this project alone. """
+        if samples is None:
+            samples = self.get_linked_entities(Sample)
+        else:
+            sample_ids = self.xlinks.get("ena-sample")
+            samples = Entity.parse_xlink_ids(sample_ids).select(samples) if sample_ids else dict()
+        if experiments is None:
+            experiments = self.get_linked_entities(Experiment)
+        if runs is None:
+            runs = self.get_linked_entities(Run)
+        self.children = samples
 
         for sample_id, sample in samples.items():
             experiment_ids = sample.xlinks.get("ena-experiment")
@@ -253,23 +237,23 @@ class Project(Entity):
                         raise ValueError("didn't parse run {} for project {}".format(run_id, self.primary_id))
                     experiment.children[run_id] = run
     @classmethod
-    def from_xml(cls, xml):
+    def from_xml(cls, xml, fetch_children=True):
         attribs = Entity.parse_common_fields(xml, caller=cls)
 
-        tax_attribs = xml.find("SUBMISSION_PROJECT").find("ORGANISM")
+        tax_attribs = xml.find(".//SUBMISSION_PROJECT").find(".//ORGANISM")
         try:
-            taxon_id, scientific_name = map(lambda x:x.text, tax_attribs.children)
+            taxon_id, scientific_name = map(Entity.get_text, tax_attribs)
         except:
             taxon_id, scientific_name = None, None
         attribs.update({"taxon_id": taxon_id, "scientific_name": scientific_name})
 
-        attribs["xlinks"] = Entity.parse_xlinks(xml.find("PROJECT_LINKS"))
+        attribs["xlinks"] = Entity.parse_xlinks(xml.find(".//PROJECT_LINKS"))
 
-        proj_attribs = dict(Entity.get_tag_value_pairs(xml.find("PROJECT_ATTRIBUTES")))
+        proj_attribs = dict(Entity.get_tag_value_pairs(xml.find(".//PROJECT_ATTRIBUTES")))
         attribs["ena_first_public"] = proj_attribs.get("ena-first-public")
         attribs["ena_last_update"] = proj_attribs.get("ena-last-update")
 
-        return Project(**attribs)
+        return Project(fetch_children=fetch_children, **attribs)
 
     def as_tuple(self):
         return (self.primary_id, self.secondary_id, self.name, self.title,
@@ -317,6 +301,89 @@ def update_links(cursor, entity1, entity2):
             print("new link: {} <- {}".format(entity1.primary_id, entity2.primary_id))
         insert_record(cursor, link_table, (entity1.primary_id, entity2.primary_id))
 
+class TreeSync:
+    """ Writes a project tree with a constant number of statements per table:
+    the tree is flattened into rows per entity table and edges per link table,
+    which are diffed against the db via temp tables and written with executemany. """
+    ENTITY_TABLES = (("project", Project), ("sample", Sample), ("experiment", Experiment), ("run", Run))
+    LINK_TABLES = (("project_sample", "project_id", "sample_id"),
+                   ("sample_experiment", "sample_id", "experiment_id"),
+                   ("experiment_run", "experiment_id", "run_id"))
+    def __init__(self, cursor):
+        self.cursor = cursor
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS sync_ids(id TEXT PRIMARY KEY);")
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS sync_links(id1 TEXT NOT NULL, id2 TEXT NOT NULL, PRIMARY KEY (id1, id2));")
+    @staticmethod
+    def create_indexes(cursor):
+        """ the link table indexes of create_ena_db.sql, for dbs created before they were added there """
+        for table, col1, col2 in TreeSync.LINK_TABLES:
+            cursor.execute("CREATE INDEX IF NOT EXISTS {table}_ids ON {table}({col1}, {col2});".format(table=table, col1=col1, col2=col2))
+    @staticmethod
+    def flatten(project):
+        """ -> ({table: {id: entity}}, {link_table: [(id1, id2), ...]}) """
+        nodes = {table: dict() for table, _ in TreeSync.ENTITY_TABLES}
+        edges = {table: dict() for table, _, _ in TreeSync.LINK_TABLES}
+        stack = [project]
+        while stack:
+            entity = stack.pop()
+            table = entity.__class__.__name__.lower()
+            nodes[table].setdefault(entity.primary_id, entity)
+            for child_id, child in entity.children.items():
+                link_table = "_".join((table, child.__class__.__name__.lower()))
+                edges[link_table][(entity.primary_id, child.primary_id)] = None
+            # reversed, so that records are visited in tree order
+            stack.extend(reversed(list(entity.children.values())))
+        return nodes, {table: list(table_edges) for table, table_edges in edges.items()}
+    def sync(self, project):
+        """ Inserts new and updates newer records and adds missing links, returns whether any record changed. """
+        nodes, edges = TreeSync.flatten(project)
+        has_updates = False
+        for table, _ in TreeSync.ENTITY_TABLES:
+            with METRICS.timer("db_seconds", table=table):
+                has_updates |= self.sync_records(table, nodes[table])
+        for table, col1, col2 in TreeSync.LINK_TABLES:
+            with METRICS.timer("db_seconds", table=table):
+                self.sync_links(table, col1, col2, edges[table])
+        return has_updates
+    def sync_records(self, table, entities):
+        if not entities:
+            return False
+        self.cursor.execute("DELETE FROM sync_ids;")
+        self.cursor.executemany("INSERT INTO sync_ids VALUES (?);", ((_id,) for _id in entities))
+        self.cursor.execute("SELECT {table}.* FROM {table} JOIN sync_ids USING (id);".format(table=table))
+        columns = [d[0] for d in self.cursor.description]
+        current_rows = {row[0]: row for row in self.cursor.fetchall()}
+
+        new_records, updated_records = list(), list()
+        for _id, entity in entities.items():
+            current_row = current_rows.get(_id)
+            if current_row is None:
+                if DEBUG:
+                    print("new {table} record: {id}".format(table=table, id=_id))
+                new_records.append(entity.as_tuple())
+            elif entity.is_newer_than(current_row):
+                print("record updated:", table, _id, entity.get_changes(columns, current_row))
+                updated_records.append(entity.as_tuple()[1:] + (_id,))
+            elif DEBUG:
+                print("existing record", table, _id)
+
+        METRICS.count_records(table, len(new_records), len(updated_records), len(entities) - len(new_records) - len(updated_records))
+        if new_records:
+            self.cursor.executemany("INSERT INTO {table} VALUES ({dummy});".format(
+                table=table, dummy=",".join("?" for _ in columns)), new_records)
+        if updated_records:
+            self.cursor.executemany("UPDATE {table} SET {update_ops} WHERE id = ?;".format(
+                table=table, update_ops=", ".join("{col} = ?".format(col=col) for col in columns[1:])), updated_records)
+        return bool(new_records or updated_records)
+    def sync_links(self, table, col1, col2, links):
+        if not links:
+            return
+        self.cursor.execute("DELETE FROM sync_links;")
+        self.cursor.executemany("INSERT INTO sync_links VALUES (?, ?);", links)
+        self.cursor.execute("""INSERT INTO {table} ({col1}, {col2})
+            SELECT id1, id2 FROM sync_links
+            WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE {col1} = id1 AND {col2} = id2);""".format(table=table, col1=col1, col2=col2))
+
 def update_record(cursor, table, _id, updates):
     update_ops = ", ".join(["{col} = ?".format(col=col) for col, _ in updates])
     cmd = "UPDATE {table} SET {update_ops} WHERE id = ?;".format(table=table, update_ops=update_ops)
@@ -327,48 +394,99 @@ def update_record(cursor, table, _id, updates):
         for row in res:
             print(row)
 
-def rest_query(query_str, base_url=BASE_API_URL, verbose=False):
-    time.sleep(0.1)
+def iter_entities(xml, entity_type, **kwargs):
+    """ Builds entity_type objects from a (file-like) xml document, one element at a time.
+    Each element is freed as soon as its entity is built. """
+    tag = entity_type.__name__.upper()
+    for _, element in etree.iterparse(xml, events=("end",), tag=tag):
+        try:
+            with METRICS.timer("parse_seconds", format="xml", entity=tag.lower()):
+                entity = entity_type.from_xml(element, **kwargs)
+        except Exception as e:
+            raise EntityParseError("{entity_type} could not be parsed.\n{xml}".format(
+                entity_type=tag.lower(), xml=etree.tostring(element).decode())) from e
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+        yield entity
+
+def query_entities(query_str, entity_type, base_url=BASE_API_URL, verbose=False, **kwargs):
     if verbose:
         print(base_url + query_str)
-    xml = requests.get(base_url + query_str).content.decode()
-    xml = xml.replace("\n", "")
-    xml = re.sub(">\s+<", "><", xml)
-    # https://stackoverflow.com/questions/14822188/dont-put-html-head-and-body-tags-automatically-beautifulsoup
-    # THIS SHOULD BE IN THE MAIN DOCS...
-    soup = BeautifulSoup(xml, "lxml-xml")
-    return soup
-
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("db")
-    args = ap.parse_args()
+    response = http_client.get(base_url + query_str, stream=True)
+    response.raw.decode_content = True
+    with response:
+        yield from iter_entities(response.raw, entity_type, **kwargs)
+
+class HierarchyFetcher:
+    """ Fetches the samples, experiments and runs of groups of projects with batched POST requests
+    (batch_size id ranges each), sent concurrently and throttled by the http_client host rate limit. """
+    def __init__(self, batch_size=100, concurrency=4, group_size=50, base_url=BASE_API_URL):
+        self.batch_size = batch_size
+        self.concurrency = max(1, concurrency)
+        self.group_size = group_size
+        self.url = base_url.rstrip("/")
+    def query(self, idranges, entity_type):
+        response = http_client.post(self.url, data=[("accessions", idrange) for idrange in idranges], stream=True)
+        response.raw.decode_content = True
+        with response:
+            return list(iter_entities(response.raw, entity_type))
+    def fetch(self, projects, pool):
+        entities = dict()
+        futures = list()
+        for entity_type in (Sample, Experiment, Run):
+            entities[entity_type] = dict()
+            idranges = set()
+            for project in projects:
+                ids = project.xlinks.get("ena-{}".format(entity_type.__name__.lower()))
+                if ids:
+                    idranges.update(Entity.parse_xlink_ids(ids).query_strings())
+            for batch in chunked(sorted(idranges), self.batch_size):
+                futures.append((entity_type, pool.submit(self.query, batch, entity_type)))
+        for entity_type, future in futures:
+            for entity_obj in future.result():
+                entities[entity_type][entity_obj.primary_id] = entity_obj
+        return entities[Sample], entities[Experiment], entities[Run]
+    def iter_projects(self, projects):
+        """ Yields the projects in order, each with its children linked. """
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for group in chunked(projects, self.group_size):
+                samples, experiments, runs = self.fetch(group, pool)
+                for project in group:
+                    try:
+                        project._process_children(samples=samples, experiments=experiments, runs=runs)
+                    except:
+                        project.show()
+                        raise
+                    yield project
 
+def sync_projects(args):
     conn = sqlite3.connect(args.db)
     with conn:
         cursor = conn.cursor()
         latest_timestamp = get_latest_timestamp(cursor)
+        TreeSync.create_indexes(cursor)
+        conn.commit()
+        tree_sync = TreeSync(cursor)
 
-        soup = rest_query(PROJECT_QUERY)
-        projects = soup.PROJECT_SET
-
-        for i, project in enumerate(projects.find_all("PROJECT")):
-            #if i > 10:
-            #    break
-                
-            try:
-                project = Project.from_xml(project)
-            except:
-                print(project)
-                raise
+        # read the (small) project list first, children are fetched for groups of projects below
+        projects = list(query_entities(PROJECT_QUERY, Project, fetch_children=False))
+        fetcher = HierarchyFetcher(batch_size=args.batch_size, concurrency=args.concurrency, group_size=args.group_size)
 
+        for project in fetcher.iter_projects(projects):
             for pmid in project.xlinks.get("pubmed", list()):
                 try:
                     insert_record(cursor, "project_pubmed", (project.primary_id, pmid))
                 except:
                     pass
 
-            has_updates = project.process_updates(cursor)
+            # one transaction per project
+            try:
+                has_updates = tree_sync.sync(project)
+            except:
+                conn.rollback()
+                raise
+            conn.commit()
             if has_updates:
                 print("UPDATES available:")
                 project.show()
@@ -376,6 +494,23 @@ def main():
                 print("Project {}: no updates".format(project.primary_id))
             print("*************************************************")
 
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("db")
+    ap.add_argument("--requests-per-second", type=float, default=10)
+    ap.add_argument("--batch-size", type=int, default=100, help="id ranges per child entity request")
+    ap.add_argument("--concurrency", type=int, default=4)
+    ap.add_argument("--group-size", type=int, default=50, help="projects whose children are fetched together")
+    metrics.add_arguments(ap)
+    args = ap.parse_args()
+
+    http_client.set_rate_limit(urllib.parse.urlsplit(BASE_API_URL).netloc, args.requests_per_second)
+
+    try:
+        sync_projects(args)
+    finally:
+        metrics.write_report(args, "ena_scryer")
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,123 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import METRICS
+from ratelimit import TokenBucket
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout,
+                    requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError)
+
+
+class HTTPClientError(Exception):
+    ...
+
+
+def count_response_bytes(response, host, stream=False):
+    # bytes on the wire, i.e. before gzip decoding, whether the body is streamed or not
+    if not stream:
+        # reads the whole body
+        response.content
+        METRICS.inc("http_response_bytes_total", response.raw.tell(), host=host)
+        return
+    # streamed bodies are only read by the caller, count them once the response is closed
+    close = response.close
+    def counting_close():
+        METRICS.inc("http_response_bytes_total", response.raw.tell(), host=host)
+        close()
+    response.close = counting_close
+
+
+def get_retry_after(response):
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class HTTPClient:
+    """ One pooled, keep-alive session shared by all crawlers.
+    Retries connection errors, 429 and 5xx with jittered exponential backoff (or as long as Retry-After says)
+    and throttles requests per host. """
+    def __init__(self, timeout=(10, 300), retries=5, backoff=1.0, max_backoff=120, pool_size=16):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Accept-Encoding"] = "gzip, deflate"
+        self.buckets = dict()
+        self.lock = threading.Lock()
+    def set_rate_limit(self, host, requests_per_second, burst=1):
+        with self.lock:
+            self.buckets[host] = TokenBucket(requests_per_second, burst=burst)
+    def _get_bucket(self, url):
+        with self.lock:
+            return self.buckets.get(urlsplit(url).netloc)
+    def _get_backoff(self, attempt):
+        # "full jitter": spreads out retries of concurrent workers
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        bucket = self._get_bucket(url)
+        host = urlsplit(url).netloc
+        for attempt in range(self.retries + 1):
+            if bucket is not None:
+                bucket.acquire()
+            if attempt:
+                METRICS.inc("http_retries_total", host=host, method=method)
+            wait = None
+            try:
+                with METRICS.timer("http_request_seconds", host=host, method=method):
+                    response = self.session.request(method, url, **kwargs)
+            except RETRY_EXCEPTIONS as e:
+                METRICS.inc("http_requests_total", host=host, method=method, status="error")
+                error = e
+            else:
+                METRICS.inc("http_requests_total", host=host, method=method, status=response.status_code)
+                if response.status_code not in RETRY_STATUS:
+                    try:
+                        response.raise_for_status()
+                    except requests.HTTPError as e:
+                        raise HTTPClientError(f"{method} {url} failed: {e}") from e
+                    count_response_bytes(response, host, stream=kwargs.get("stream", False))
+                    return response
+                error = f"status {response.status_code}"
+                wait = get_retry_after(response)
+                response.close()
+            if attempt == self.retries:
+                raise HTTPClientError(f"{method} {url} failed after {attempt + 1} attempts: {error}")
+            time.sleep(min(self.max_backoff, wait) if wait is not None else self._get_backoff(attempt))
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+DEFAULT_CLIENT = HTTPClient()
+
+def get(url, **kwargs):
+    return DEFAULT_CLIENT.get(url, **kwargs)
+
+def post(url, **kwargs):
+    return DEFAULT_CLIENT.post(url, **kwargs)
+
+def set_rate_limit(host, requests_per_second, burst=1):
+    DEFAULT_CLIENT.set_rate_limit(host, requests_per_second, burst=burst)
@@ -0,0 +1,182 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+PREFIX = "mgscryer_"
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+HELP = {
+    "http_requests_total": ("counter", "HTTP requests sent, by host, method and response status"),
+    "http_retries_total": ("counter", "HTTP requests that were retried"),
+    "http_response_bytes_total": ("counter", "bytes received in HTTP response bodies, before decompression"),
+    "http_request_seconds": ("histogram", "time until the response headers arrived"),
+    "parse_seconds": ("histogram", "time spent parsing responses"),
+    "db_seconds": ("histogram", "time spent writing to the database, by table"),
+    "shard_seconds": ("histogram", "time taken to crawl one shard of a sharded backfill"),
+    "records_total": ("counter", "records seen, by table and state (new, updated, unchanged)"),
+    "run_seconds": ("gauge", "wall time of the crawl"),
+    "rows_per_second": ("gauge", "records seen per second of crawl wall time"),
+    "last_run_timestamp_seconds": ("gauge", "unix time at which the crawl finished"),
+}
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics:
+    """ Thread-safe counters, gauges and histograms, keyed by name and labels.
+    Written once per run as a JSON report and as a Prometheus textfile-collector file. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+    def reset(self):
+        with self.lock:
+            self.counters = dict()
+            self.gauges = dict()
+            self.histograms = dict()
+            self.started = time.time()
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+    def inc(self, name, value=1, **labels):
+        key = Metrics._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[Metrics._key(name, labels)] = value
+    def observe(self, name, value, **labels):
+        key = Metrics._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+    def drain(self):
+        """ -> (counters, histograms) recorded so far, and starts them over.
+        Lets a worker process hand its metrics to merge() in the parent. """
+        with self.lock:
+            drained = self.counters, self.histograms
+            self.counters, self.histograms = dict(), dict()
+        return drained
+    def merge(self, drained):
+        counters, histograms = drained
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, histogram in histograms.items():
+                if key in self.histograms:
+                    self.histograms[key].merge(histogram)
+                else:
+                    self.histograms[key] = histogram
+    def count_records(self, table, new, updated, unchanged):
+        for state, n in (("new", new), ("updated", updated), ("unchanged", unchanged)):
+            if n:
+                self.inc("records_total", n, table=table, state=state)
+    def finish(self):
+        """ sets the run gauges, call once the crawl is done """
+        now = time.time()
+        run_seconds = now - self.started
+        with self.lock:
+            n_records = sum(value for (name, _), value in self.counters.items() if name == "records_total")
+        self.set("run_seconds", run_seconds)
+        self.set("rows_per_second", n_records / run_seconds if run_seconds else 0.0)
+        self.set("last_run_timestamp_seconds", now)
+    def to_dict(self):
+        with self.lock:
+            report = {"started": self.started, "counters": list(), "gauges": list(), "histograms": list()}
+            for (name, labels), value in sorted(self.counters.items()):
+                report["counters"].append({"name": name, "labels": dict(labels), "value": value})
+            for (name, labels), value in sorted(self.gauges.items()):
+                report["gauges"].append({"name": name, "labels": dict(labels), "value": value})
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                report["histograms"].append({
+                    "name": name, "labels": dict(labels), "count": histogram.count, "sum": histogram.sum,
+                    "buckets": {str(bound): count for bound, count in histogram.cumulative()},
+                })
+        return report
+    def to_prometheus(self, **const_labels):
+        def format_labels(labels, **extra):
+            labels = dict(const_labels, **dict(labels), **extra)
+            if not labels:
+                return ""
+            return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                                  for k, v in sorted(labels.items())) + "}"
+
+        samples = dict()
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                samples.setdefault(name, list()).append(f"{PREFIX}{name}{format_labels(labels)} {value}")
+            for (name, labels), value in self.gauges.items():
+                samples.setdefault(name, list()).append(f"{PREFIX}{name}{format_labels(labels)} {value}")
+            for (name, labels), histogram in self.histograms.items():
+                lines = samples.setdefault(name, list())
+                for bound, count in histogram.cumulative():
+                    lines.append(f"{PREFIX}{name}_bucket{format_labels(labels, le=bound)} {count}")
+                lines.append(f"{PREFIX}{name}_bucket{format_labels(labels, le='+Inf')} {histogram.count}")
+                lines.append(f"{PREFIX}{name}_sum{format_labels(labels)} {histogram.sum}")
+                lines.append(f"{PREFIX}{name}_count{format_labels(labels)} {histogram.count}")
+        text = list()
+        for name in sorted(samples):
+            metric_type, help_text = HELP.get(name, ("untyped", name))
+            text.append(f"# HELP {PREFIX}{name} {help_text}")
+            text.append(f"# TYPE {PREFIX}{name} {metric_type}")
+            text.extend(samples[name])
+        return "\n".join(text) + "\n"
+    def write_report(self, json_path=None, prometheus_path=None, crawler=None):
+        const_labels = {"crawler": crawler} if crawler else dict()
+        if json_path:
+            report = self.to_dict()
+            report.update(const_labels)
+            write_atomic(json_path, json.dumps(report, indent=2))
+        if prometheus_path:
+            write_atomic(prometheus_path, self.to_prometheus(**const_labels))
+
+
+def write_atomic(path, text):
+    # the textfile collector may read at any time, never let it see a half-written file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as _out:
+        _out.write(text)
+    os.replace(tmp_path, path)
+
+
+METRICS = Metrics()
+
+def add_arguments(ap):
+    ap.add_argument("--metrics-json", help="write a JSON report of the crawl metrics to this file")
+    ap.add_argument("--metrics-prom", help="write the crawl metrics to this Prometheus textfile-collector file (*.prom)")
+
+def write_report(args, crawler):
+    METRICS.finish()
+    METRICS.write_report(json_path=args.metrics_json, prometheus_path=args.metrics_prom, crawler=crawler)
@@ -0,0 +1,177 @@
+import sqlite3
+
+# (version, statements) - append only, each migration is applied once and in order
+MIGRATIONS = [
+    (1, [
+        # covering indexes for the grouped display queries and the per-study/per-sample api listings
+        "CREATE INDEX IF NOT EXISTS sample_study_type ON sample "
+        "(study_accession, host, host_body_site, host_tax_id, environment_biome);",
+        "CREATE INDEX IF NOT EXISTS run_sample_type ON run "
+        "(sample_accession, instrument_model, instrument_platform, library_source, "
+        "library_layout, library_strategy, nominal_length);",
+        # incremental syncs and last_updated filters
+        "CREATE INDEX IF NOT EXISTS study_last_updated ON study (last_updated);",
+        "CREATE INDEX IF NOT EXISTS run_last_updated ON run (last_updated);",
+        "CREATE INDEX IF NOT EXISTS study_taxtree_tax_tree ON study_taxtree (tax_tree, study_accession);",
+    ]),
+    (2, [
+        # when the pubmed links of a study were last looked up
+        "CREATE TABLE IF NOT EXISTS study_pubmed_checked("
+        "study_accession TEXT PRIMARY KEY, "
+        "checked TEXT NOT NULL);",
+        "INSERT OR IGNORE INTO study_pubmed_checked "
+        "SELECT DISTINCT study_accession, strftime('%Y-%m-%dT%H:%M:%S', 'now', 'localtime') FROM study_pubmed;",
+    ]),
+    (3, [
+        # crawl progress per tax tree, written in the same transaction as the records it covers
+        "CREATE TABLE IF NOT EXISTS crawl_checkpoint("
+        "crawl TEXT NOT NULL, "
+        "tax_tree INTEGER NOT NULL, "
+        "watermark TEXT, "
+        "offset INTEGER NOT NULL DEFAULT 0, "
+        "done INTEGER NOT NULL DEFAULT 0, "
+        "updated TEXT NOT NULL, "
+        "PRIMARY KEY (crawl, tax_tree));",
+    ]),
+    (4, [
+        # bulk loads: rows that couldn't be loaded, and the indexes dropped while loading
+        "CREATE TABLE IF NOT EXISTS load_reject("
+        "rejected TEXT NOT NULL, "
+        "crawl TEXT, "
+        "reason TEXT NOT NULL, "
+        "record TEXT NOT NULL);",
+        "CREATE TABLE IF NOT EXISTS bulk_dropped_index("
+        "name TEXT PRIMARY KEY, "
+        "sql TEXT NOT NULL);",
+    ]),
+    (5, [
+        # one row per crawl, status: running, finished or aborted (interrupted and not resumed)
+        "CREATE TABLE IF NOT EXISTS crawl_log("
+        "crawl_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "crawl TEXT NOT NULL, "
+        "started TEXT NOT NULL, "
+        "finished TEXT, "
+        "status TEXT NOT NULL DEFAULT 'running');",
+        # append-only log of the inserted and updated study/sample/run records, columns is a json list (NULL for inserts)
+        "CREATE TABLE IF NOT EXISTS changes("
+        "change_id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "crawl_id INTEGER NOT NULL, "
+        "entity TEXT NOT NULL, "
+        "accession TEXT NOT NULL, "
+        "kind TEXT NOT NULL, "
+        "columns TEXT, "
+        "FOREIGN KEY (crawl_id) REFERENCES crawl_log (crawl_id));",
+        "CREATE INDEX IF NOT EXISTS changes_crawl ON changes (crawl_id, entity);",
+        "CREATE INDEX IF NOT EXISTS changes_accession ON changes (entity, accession);",
+        "CREATE TRIGGER IF NOT EXISTS changes_append_only BEFORE UPDATE ON changes "
+        "BEGIN SELECT RAISE(ABORT, 'changes is append-only'); END;",
+    ]),
+    (6, [
+        # per-study aggregates for the study overview, kept up to date by the scryers (see study_summary.py)
+        "CREATE TABLE IF NOT EXISTS study_summary("
+        "study_accession TEXT PRIMARY KEY, "
+        "n_samples INTEGER NOT NULL, "
+        "n_runs INTEGER NOT NULL);",
+        "CREATE TABLE IF NOT EXISTS study_sample_type("
+        "study_accession TEXT NOT NULL, "
+        "host TEXT, host_body_site TEXT, host_tax_id TEXT, environment_biome TEXT, "
+        "n_samples INTEGER NOT NULL);",
+        "CREATE INDEX IF NOT EXISTS study_sample_type_study ON study_sample_type "
+        "(study_accession, host, host_body_site, host_tax_id, environment_biome);",
+        "CREATE TABLE IF NOT EXISTS study_run_type("
+        "study_accession TEXT NOT NULL, "
+        "host TEXT, host_body_site TEXT, host_tax_id TEXT, environment_biome TEXT, "
+        "instrument_model TEXT, instrument_platform TEXT, library_source TEXT, "
+        "library_layout TEXT, library_strategy TEXT, nominal_length INTEGER, "
+        "n_runs INTEGER NOT NULL);",
+        "CREATE INDEX IF NOT EXISTS study_run_type_study ON study_run_type "
+        "(study_accession, host, host_body_site, host_tax_id, environment_biome, "
+        "instrument_model, instrument_platform, library_source, library_layout, library_strategy, nominal_length);",
+        "INSERT INTO study_summary "
+        "SELECT sample.study_accession, COUNT(DISTINCT sample.sample_accession), COUNT(run.run_accession) "
+        "FROM sample LEFT JOIN run ON run.sample_accession = sample.sample_accession "
+        "GROUP BY sample.study_accession;",
+        "INSERT INTO study_sample_type "
+        "SELECT study_accession, host, host_body_site, host_tax_id, environment_biome, COUNT(*) "
+        "FROM sample GROUP BY study_accession, host, host_body_site, host_tax_id, environment_biome;",
+        "INSERT INTO study_run_type "
+        "SELECT sample.study_accession, sample.host, sample.host_body_site, sample.host_tax_id, sample.environment_biome, "
+        "run.instrument_model, run.instrument_platform, run.library_source, run.library_layout, run.library_strategy, "
+        "run.nominal_length, COUNT(*) "
+        "FROM sample JOIN run ON run.sample_accession = sample.sample_accession "
+        "GROUP BY sample.study_accession, sample.host, sample.host_body_site, sample.host_tax_id, sample.environment_biome, "
+        "run.instrument_model, run.instrument_platform, run.library_source, run.library_layout, run.library_strategy, "
+        "run.nominal_length;",
+    ]),
+    (7, [
+        # full-text search, one document per study (see search.py); the fts index follows study_search by triggers
+        "CREATE TABLE IF NOT EXISTS study_search("
+        "doc_id INTEGER PRIMARY KEY, "
+        "study_accession TEXT NOT NULL UNIQUE, "
+        "study_title TEXT, "
+        "experiment_titles TEXT, "
+        "descriptions TEXT);",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS study_fts USING fts5("
+        "study_title, experiment_titles, descriptions, "
+        "content='study_search', content_rowid='doc_id', tokenize='porter unicode61');",
+        "CREATE TRIGGER IF NOT EXISTS study_search_insert AFTER INSERT ON study_search BEGIN "
+        "INSERT INTO study_fts (rowid, study_title, experiment_titles, descriptions) "
+        "VALUES (new.doc_id, new.study_title, new.experiment_titles, new.descriptions); END;",
+        "CREATE TRIGGER IF NOT EXISTS study_search_delete AFTER DELETE ON study_search BEGIN "
+        "INSERT INTO study_fts (study_fts, rowid, study_title, experiment_titles, descriptions) "
+        "VALUES ('delete', old.doc_id, old.study_title, old.experiment_titles, old.descriptions); END;",
+        "CREATE TRIGGER IF NOT EXISTS study_search_update AFTER UPDATE ON study_search BEGIN "
+        "INSERT INTO study_fts (study_fts, rowid, study_title, experiment_titles, descriptions) "
+        "VALUES ('delete', old.doc_id, old.study_title, old.experiment_titles, old.descriptions); "
+        "INSERT INTO study_fts (rowid, study_title, experiment_titles, descriptions) "
+        "VALUES (new.doc_id, new.study_title, new.experiment_titles, new.descriptions); END;",
+        "INSERT INTO study_search (study_accession, study_title, experiment_titles, descriptions) "
+        "SELECT study.study_accession, study.study_title, "
+        "group_concat(DISTINCT run.experiment_title), group_concat(DISTINCT run.description) "
+        "FROM study "
+        "LEFT JOIN sample ON sample.study_accession = study.study_accession "
+        "LEFT JOIN run ON run.sample_accession = sample.sample_accession "
+        "GROUP BY study.study_accession;",
+    ]),
+]
+
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL;",
+    # with WAL, NORMAL only risks the last transactions on power loss, not corruption
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA cache_size = -65536;",
+    "PRAGMA mmap_size = 268435456;",
+]
+
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version;").fetchone()[0]
+
+def migrate(conn):
+    version = get_schema_version(conn)
+    for migration_version, statements in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        conn.execute("BEGIN;")
+        try:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute("PRAGMA user_version = {:d};".format(migration_version))
+        except sqlite3.Error:
+            conn.execute("ROLLBACK;")
+            raise
+        conn.execute("COMMIT;")
+        version = migration_version
+    return version
+
+def connect(path, **kwargs):
+    """ a connection with PRAGMAS, for dbs known to be migrated already """
+    conn = sqlite3.connect(path, **kwargs)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def open_db(path, **kwargs):
+    conn = connect(path, **kwargs)
+    migrate(conn)
+    return conn
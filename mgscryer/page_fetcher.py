@@ -0,0 +1,52 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from ratelimit import TokenBucket
+
+
+def close_page(page):
+    """ pages can hold an open (streamed) response, lists can't """
+    close = getattr(page, "close", None)
+    if close is not None:
+        close()
+
+def close_fetched_page(future):
+    if not future.cancelled() and future.exception() is None:
+        close_page(future.result())
+
+class PageFetcher:
+    """ Fetches offset pages ahead of the consumer, but hands out their records in page order.
+    Iteration ends after the first page that returns fewer than limit records. """
+    def __init__(self, fetch_page, limit, offset=0, concurrency=1, requests_per_second=None, bucket=None):
+        self.fetch_page = fetch_page
+        self.limit = limit
+        self.offset = offset
+        self.concurrency = max(1, concurrency)
+        self.bucket = bucket or TokenBucket(requests_per_second)
+    def _fetch(self, offset):
+        self.bucket.acquire()
+        return self.fetch_page(offset)
+    def __iter__(self):
+        offset = self.offset
+        pending = deque()
+        page = None
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            try:
+                while True:
+                    while len(pending) < self.concurrency:
+                        pending.append(pool.submit(self._fetch, offset))
+                        offset += self.limit
+                    page = pending.popleft().result()
+                    n_records = 0
+                    for record in page:
+                        n_records += 1
+                        yield record
+                    close_page(page)
+                    if n_records < self.limit:
+                        break
+            finally:
+                close_page(page)
+                for future in pending:
+                    # pages fetched ahead (or still being fetched) are closed once they are there
+                    if not future.cancel():
+                        future.add_done_callback(close_fetched_page)
@@ -0,0 +1,38 @@
+from contextlib import closing
+
+import http_client
+
+
+class PortalResponseError(Exception):
+    ...
+
+
+def iter_tsv_records(response):
+    """ Yields one dict per data line of a streamed format=tsv portal response,
+    so that only the current line is held in memory. """
+    with closing(response):
+        lines = (line.decode() for line in response.iter_lines())
+        header = next(lines, None)
+        if not header:
+            return
+        header = header.split("\t")
+        for line in lines:
+            if line:
+                fields = line.split("\t")
+                # a short line or a tab within a value would shift the columns
+                if len(fields) != len(header):
+                    raise PortalResponseError(f"Expected {len(header)} fields, got {len(fields)}: {line!r}")
+                yield dict(zip(header, fields))
+
+class StreamedRecords:
+    """ The records of a streamed response, which close() also closes if they were never iterated. """
+    def __init__(self, response):
+        self.response = response
+    def __iter__(self):
+        return iter_tsv_records(self.response)
+    def close(self):
+        self.response.close()
+
+def stream_tsv_records(query):
+    # the request is sent here, the body is only read while iterating
+    return StreamedRecords(http_client.get(query, stream=True))
@@ -1,30 +1,50 @@
-import re
+from concurrent.futures import ThreadPoolExecutor
 
-from bs4 import BeautifulSoup
-import requests
+from lxml import etree
+
+import http_client
+from db_helpers import chunked
+from ratelimit import TokenBucket
 
 class PubmedQuery:
+    URL = "https://www.ebi.ac.uk/ena/browser/api/xml"
+
+    @staticmethod
+    def get_ids(studies, **kwargs):
+        for _, links in PubmedQuery.get_links(studies, **kwargs):
+            yield from links
+
+    @staticmethod
+    def get_links(studies, chunk_size=200, concurrency=4, requests_per_second=5):
+        """ Yields (accessions, [(study_accession, pubmed_id), ...]) per chunk of at most chunk_size studies.
+        Chunks are fetched concurrently, but handed out in order. """
+        bucket = TokenBucket(requests_per_second)
+
+        def query_chunk(accessions):
+            bucket.acquire()
+            return accessions, list(PubmedQuery.query(accessions))
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            yield from pool.map(query_chunk, chunked(sorted(studies), chunk_size))
+
+    @staticmethod
+    def query(accessions):
+        response = http_client.post(PubmedQuery.URL, data=[("accessions", study_id) for study_id in accessions], stream=True)
+        response.raw.decode_content = True
+        with response:
+            yield from PubmedQuery.parse_xml(response.raw)
+
     @staticmethod
-    def get_ids(studies):
-        study_queries = [("accessions", study_id) for study_id in studies]
-        xml = requests.post("https://www.ebi.ac.uk/ena/browser/api/xml", data=study_queries).content.decode()
-        xml = xml.replace("\n", "")
-        xml = re.sub(">\s+<", "><", xml)
-        soup = BeautifulSoup(xml, "lxml-xml")
- 
-        if soup:
-            studies = soup.find_all("PROJECT")
-            if studies:
-                for study in studies:
-                    study_accession = study.PRIMARY_ID.text
-                    project_links = study.find("PROJECT_LINKS")
-                    if project_links:
-                        xref_links = project_links.find_all("XREF_LINK")
-                        if xref_links:
-                            for xref_link in xref_links:
-                                try:
-                                    db, pubmed_id = xref_link.DB.text, xref_link.ID.text
-                                except:
-                                    continue
-                                if db == "PUBMED":
-                                    yield study_accession, pubmed_id
+    def parse_xml(xml):
+        # only one PROJECT element is in memory at any time
+        for _, study in etree.iterparse(xml, events=("end",), tag="PROJECT"):
+            study_accession = study.findtext("IDENTIFIERS/PRIMARY_ID")
+            project_links = study.find("PROJECT_LINKS")
+            if project_links is not None:
+                for xref_link in project_links.iter("XREF_LINK"):
+                    db, pubmed_id = xref_link.findtext("DB"), xref_link.findtext("ID")
+                    if db and pubmed_id and db.strip() == "PUBMED":
+                        yield study_accession, pubmed_id.strip()
+            study.clear()
+            while study.getprevious() is not None:
+                del study.getparent()[0]
@@ -0,0 +1,108 @@
+""" Full-text search over the studies: one document per study with its title
+and the distinct experiment titles and descriptions of its runs, ranked with bm25.
+
+study_search holds the documents, study_fts (fts5, external content) indexes them and is
+kept in sync by triggers on study_search. The documents of the studies a crawl touched are
+rebuilt with their summaries (study_summary.refresh_studies).
+    python search.py mgscryer_db.sqlite "gut microbiome" --limit 20
+"""
+from __future__ import print_function
+
+import argparse
+import re
+import sqlite3
+import sys
+
+from changes import set_last_change
+from migrations import open_db
+
+# bm25 weights of study_title, experiment_titles and descriptions
+WEIGHTS = (10.0, 2.0, 1.0)
+DEFAULT_LIMIT = 20
+
+# {where} restricts the studies, on study.study_accession
+DOCUMENT_STATEMENT = """INSERT INTO study_search (study_accession, study_title, experiment_titles, descriptions)
+SELECT study.study_accession, study.study_title,
+       group_concat(DISTINCT run.experiment_title), group_concat(DISTINCT run.description)
+FROM study
+LEFT JOIN sample ON sample.study_accession = study.study_accession
+LEFT JOIN run ON run.sample_accession = sample.sample_accession
+WHERE {where}
+GROUP BY study.study_accession;"""
+
+SEARCH_QUERY = """
+SELECT study_search.study_accession, study_search.study_title,
+       COALESCE(study_summary.n_samples, 0), COALESCE(study_summary.n_runs, 0),
+       bm25(study_fts, {weights}) AS score
+FROM study_fts
+JOIN study_search ON study_search.doc_id = study_fts.rowid
+LEFT JOIN study_summary ON study_summary.study_accession = study_search.study_accession
+WHERE study_fts MATCH ?
+ORDER BY score
+LIMIT ?;
+""".strip().format(weights=", ".join(str(weight) for weight in WEIGHTS))
+RESULT_COLUMNS = ("study_accession", "study_title", "n_samples", "n_runs", "score")
+
+
+class SearchQueryError(Exception):
+    pass
+
+
+def refresh_documents(cursor, studies=None):
+    """ rebuilds the documents of the studies in the studies subquery, or of all studies """
+    if studies is None:
+        cursor.execute("DELETE FROM study_search;")
+        cursor.execute(DOCUMENT_STATEMENT.format(where="1"))
+    else:
+        cursor.execute("DELETE FROM study_search WHERE study_accession IN {studies};".format(studies=studies))
+        cursor.execute(DOCUMENT_STATEMENT.format(where="study.study_accession IN {studies}".format(studies=studies)))
+
+def to_match_query(text):
+    """ all words of text have to occur (in any column), words are matched as given, not as fts5 syntax """
+    words = re.findall(r"\w+", text, flags=re.UNICODE)
+    if not words:
+        raise SearchQueryError("nothing to search for in {!r}".format(text))
+    return " ".join('"{}"'.format(word) for word in words)
+
+def search(cursor, text, limit=DEFAULT_LIMIT, raw=False):
+    """ -> [dict(study_accession, study_title, n_samples, n_runs, score)], best match first (lowest score).
+    With raw, text is passed on as an fts5 query (phrases, OR, NOT, prefix*, column filters). """
+    try:
+        cursor.execute(SEARCH_QUERY, (text if raw else to_match_query(text), limit))
+    except sqlite3.OperationalError as e:
+        # malformed raw queries, e.g. unbalanced quotes or unknown columns
+        if raw or "fts5" in str(e):
+            raise SearchQueryError(str(e))
+        raise
+    return [dict(zip(RESULT_COLUMNS, row)) for row in cursor.fetchall()]
+
+
+def main():
+    ap = argparse.ArgumentParser(description="find studies by words in their title and in their runs' titles and descriptions")
+    ap.add_argument("db")
+    ap.add_argument("query")
+    ap.add_argument("--limit", type=int, default=DEFAULT_LIMIT)
+    ap.add_argument("--raw", action="store_true", help="query is in fts5 syntax, e.g. 'gut NOT infant' or 'metagenom*'")
+    ap.add_argument("--rebuild", action="store_true", help="rebuild all documents first")
+    args = ap.parse_args()
+
+    conn = open_db(args.db)
+    cursor = conn.cursor()
+    if args.rebuild:
+        with conn:
+            refresh_documents(cursor)
+            set_last_change(cursor)
+    try:
+        results = search(cursor, args.query, limit=args.limit, raw=args.raw)
+    except SearchQueryError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        conn.close()
+    print(*RESULT_COLUMNS, sep="\t")
+    for result in results:
+        print(*(result[col] if col != "score" else "{:.3f}".format(result[col]) for col in RESULT_COLUMNS), sep="\t")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import re
+from array import array
+from bisect import bisect_left
+
+from accessions import split_accession
+
+DATE_PATTERN = re.compile(r"^([0-9]{4})-([0-9]{2})-([0-9]{2})$")
+
+
+def encode_date(date):
+    match = DATE_PATTERN.match(date) if date else None
+    if match is None:
+        return None
+    year, month, day = map(int, match.groups())
+    return year * 10000 + month * 100 + day
+
+def decode_date(value):
+    return f"{value // 10000:04d}-{value // 100 % 100:02d}-{value % 100:02d}"
+
+
+class LastUpdatedSnapshot:
+    """ accession -> last_updated for one table, loaded once at the start of a crawl.
+    Regular accessions and dates are stored as sorted integer arrays per (prefix, width),
+    everything else (and everything written during the crawl) goes into a small overlay dict. """
+    def __init__(self):
+        self.accessions = dict()
+        self.dates = dict()
+        self.overlay = dict()
+    @classmethod
+    def load(cls, cursor, table):
+        snapshot = cls()
+        # within one (prefix, width) block, text order is numerical order
+        cursor.execute(f"SELECT {table}_accession, last_updated FROM {table} ORDER BY {table}_accession;")
+        for accession, last_updated in cursor:
+            key, date = split_accession(accession), encode_date(last_updated)
+            if key is None or date is None:
+                snapshot.overlay[accession] = last_updated
+                continue
+            prefix, width, number = key
+            snapshot.accessions.setdefault((prefix, width), array("q")).append(number)
+            snapshot.dates.setdefault((prefix, width), array("l")).append(date)
+        return snapshot
+    def _find(self, accession):
+        key = split_accession(accession)
+        if key is None:
+            return None, None
+        prefix, width, number = key
+        numbers = self.accessions.get((prefix, width))
+        if numbers is None:
+            return None, None
+        i = bisect_left(numbers, number)
+        if i < len(numbers) and numbers[i] == number:
+            return (prefix, width), i
+        return None, None
+    def __contains__(self, accession):
+        return accession in self.overlay or self._find(accession)[0] is not None
+    def __getitem__(self, accession):
+        if accession in self.overlay:
+            return self.overlay[accession]
+        key, i = self._find(accession)
+        if key is None:
+            raise KeyError(accession)
+        return decode_date(self.dates[key][i])
+    def __setitem__(self, accession, last_updated):
+        self.overlay[accession] = last_updated
@@ -0,0 +1,87 @@
+""" Per-study aggregates behind the study overview: sample and run counts,
+samples grouped by host metadata and runs grouped by sample and library/instrument attributes.
+The search documents of the studies (search.py) are refreshed along with them.
+
+The scryers refresh the studies they touched in the transaction that touched them,
+a full rebuild (e.g. after editing the db by hand) is
+    python study_summary.py mgscryer_db.sqlite
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+from changes import set_last_change
+from migrations import open_db
+from search import refresh_documents
+
+SAMPLE_TYPE_COLUMNS = ("host", "host_body_site", "host_tax_id", "environment_biome")
+RUN_TYPE_COLUMNS = ("instrument_model", "instrument_platform", "library_source",
+                    "library_layout", "library_strategy", "nominal_length")
+
+SUMMARY_TABLES = ("study_summary", "study_sample_type", "study_run_type")
+
+SAMPLE_COLUMNS = ", ".join("sample." + col for col in SAMPLE_TYPE_COLUMNS)
+RUN_COLUMNS = ", ".join("run." + col for col in RUN_TYPE_COLUMNS)
+# {where} restricts the studies, on sample.study_accession
+SUMMARY_STATEMENTS = [
+    """INSERT INTO study_summary
+    SELECT sample.study_accession, COUNT(DISTINCT sample.sample_accession), COUNT(run.run_accession)
+    FROM sample
+    LEFT JOIN run ON run.sample_accession = sample.sample_accession
+    WHERE {where}
+    GROUP BY sample.study_accession;""",
+    """INSERT INTO study_sample_type
+    SELECT sample.study_accession, {sample_columns}, COUNT(*)
+    FROM sample
+    WHERE {{where}}
+    GROUP BY sample.study_accession, {sample_columns};""".format(sample_columns=SAMPLE_COLUMNS),
+    """INSERT INTO study_run_type
+    SELECT sample.study_accession, {sample_columns}, {run_columns}, COUNT(*)
+    FROM sample
+    JOIN run ON run.sample_accession = sample.sample_accession
+    WHERE {{where}}
+    GROUP BY sample.study_accession, {sample_columns}, {run_columns};""".format(sample_columns=SAMPLE_COLUMNS,
+                                                                              run_columns=RUN_COLUMNS),
+]
+
+
+def refresh_studies(cursor, study_accessions):
+    """ recomputes the summaries of the given studies, call in the transaction that changed them """
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS summary_study (study_accession TEXT PRIMARY KEY);")
+    cursor.execute("DELETE FROM summary_study;")
+    cursor.executemany("INSERT OR IGNORE INTO summary_study VALUES (?);", ((acc,) for acc in study_accessions))
+    for table in SUMMARY_TABLES:
+        cursor.execute("DELETE FROM {table} WHERE study_accession IN (SELECT study_accession FROM summary_study);".format(
+            table=table))
+    for statement in SUMMARY_STATEMENTS:
+        cursor.execute(statement.format(where="sample.study_accession IN (SELECT study_accession FROM summary_study)"))
+    refresh_documents(cursor, studies="(SELECT study_accession FROM summary_study)")
+
+def rebuild(cursor):
+    for table in SUMMARY_TABLES:
+        cursor.execute("DELETE FROM {table};".format(table=table))
+    for statement in SUMMARY_STATEMENTS:
+        cursor.execute(statement.format(where="1"))
+    refresh_documents(cursor)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="rebuild the per-study summaries from scratch")
+    ap.add_argument("db")
+    args = ap.parse_args()
+
+    start = time.time()
+    conn = open_db(args.db)
+    with conn:
+        cursor = conn.cursor()
+        rebuild(cursor)
+        set_last_change(cursor)
+        cursor.execute("SELECT COUNT(*) FROM study_summary;")
+        n_studies = cursor.fetchone()[0]
+    conn.close()
+    print("rebuilt the summaries of {} studies in {:.1f}s".format(n_studies, time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -38,3 +38,18 @@ CREATE TABLE run(
     secondary_accession TEXT,
     status INTEGER DEFAULT 0
 );
+
+DROP TABLE IF EXISTS lineage_watermark;
+
+CREATE TABLE lineage_watermark(
+    lineage TEXT PRIMARY KEY,
+    last_update TEXT
+);
+
+DROP TABLE IF EXISTS study_lineage;
+
+CREATE TABLE study_lineage(
+    study_id TEXT NOT NULL,
+    lineage TEXT NOT NULL,
+    PRIMARY KEY (study_id, lineage)
+);
@@ -19,6 +19,7 @@ CREATE TABLE IF NOT EXISTS project_sample(
     FOREIGN KEY ([sample_id]) REFERENCES 'samples' ([id])
         ON DELETE NO ACTION ON UPDATE NO ACTION
 );
+CREATE INDEX IF NOT EXISTS project_sample_ids ON project_sample(project_id, sample_id);
 
 DROP TABLE IF EXISTS project_pubmed;
 CREATE TABLE IF NOT EXISTS project_pubmed(
@@ -48,6 +49,7 @@ CREATE TABLE IF NOT EXISTS sample_experiment(
     FOREIGN KEY ([experiment_id]) REFERENCES 'experiments' ([id])
         ON DELETE NO ACTION ON UPDATE NO ACTION
 );
+CREATE INDEX IF NOT EXISTS sample_experiment_ids ON sample_experiment(sample_id, experiment_id);
 
 DROP TABLE IF EXISTS experiment;
 CREATE TABLE IF NOT EXISTS experiment(
@@ -70,6 +72,7 @@ CREATE TABLE IF NOT EXISTS experiment_run(
     FOREIGN KEY ([run_id]) REFERENCES 'runs' ([id])
         ON DELETE NO ACTION ON UPDATE NO ACTION
 );
+CREATE INDEX IF NOT EXISTS experiment_run_ids ON experiment_run(experiment_id, run_id);
 
 DROP TABLE IF EXISTS run;
 CREATE TABLE IF NOT EXISTS run(